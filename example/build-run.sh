@@ -36,8 +36,8 @@ cat > br.sh <<EOF
     riscv32-unknown-elf-clang \$CFLAGS $XFLAGS -c dhry_2.c -o dhry_2.o
     riscv32-unknown-elf-clang dhry_1.o dhry_2.o -o dhry
 
-    # execute0
-    echo 1000 | riscv32-unknown-elf-qemu -count-ifetch dhry # qemu-x86_64 -tcg-plugin icount dhry
+    # execute0 (number of iterations given by xplfl fidelity XFIDELITY)
+    echo ${XFIDELITY:-1000} | riscv32-unknown-elf-qemu -count-ifetch dhry # qemu-x86_64 -tcg-plugin icount dhry
 EOF
 
 timeout 10 bash ./br.sh > log 2>&1
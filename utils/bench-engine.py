@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import os, sys, re, json, time, random, hashlib, optparse, resource
+import subprocess, tempfile, itertools
+
+# usage: bench-engine.py [options]
+#   measures exploration engine overhead: all generators are driven
+#   in-process on dryrun runs, with synthetic objectives computed from
+#   XFLAGS, and results are printed as one json object per case
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                __file__))))
+import xplfl
+
+
+# ####################################################################
+
+class objectives():
+
+    # per flag (and per flag pair) weights, derived from flag strings
+    weights = {}
+
+    @staticmethod
+    def weight(key, scale):
+        if key not in objectives.weights:
+            objectives.weights[key] = objectives.hashed(key) * scale
+        return objectives.weights[key]
+
+    # integer in [-20, 20] given a string
+    @staticmethod
+    def hashed(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16) % 41 - 20
+
+    @staticmethod
+    def additive(flags):
+        return 10000 + sum([objectives.weight(f, 10) for f in flags])
+
+    @staticmethod
+    def interacting(flags):
+        # neighbour flags (in sorted order) interact one time out of four,
+        # keeping the cost linear in the number of flags
+        flags = sorted(flags)
+        pairs = [objectives.hashed(f1 + ' ' + f2)
+                 for (f1, f2) in zip(flags, flags[1:])]
+        return objectives.additive(flags) + sum(
+            [w * 40 for w in pairs if w % 4 == 0])
+
+    noise = random.Random(0)
+
+    @staticmethod
+    def noisy(flags):
+        return objectives.additive(flags) * objectives.noise.gauss(1, 0.02)
+
+    # dryrun output given the run command args
+    @staticmethod
+    def output(name):
+        func = getattr(objectives, name)
+        def dryrun_output(args):
+            env = dict([a.split('=', 1) for a in args[1:]
+                        if re.match('^X[A-Z]+=', a)])
+            flags = xplfl.opt_flag_list.parse_line(env['XFLAGS'])
+            return 'XRES %d\n' % max(1, int(func(flags)))
+        return dryrun_output
+
+    names = ['additive', 'interacting', 'noisy']
+
+
+# ####################################################################
+
+# flags list of nb synthetic flags, choices and ranges
+def generate_flags(nb, dirname):
+    filename = os.path.join(dirname, 'flags_bench_%d.txt' % nb)
+    with open(filename, 'w') as stream:
+        for n in range(nb):
+            if n % 4 == 3:
+                print >>stream, '--param bench-param-%d=[0..100]' % n
+            else:
+                print >>stream, '-fbench-flag-%d|-fno-bench-flag-%d' % (n, n)
+    return filename
+
+
+# values of required generator arguments, other than configs
+generator_values = {'max_fidelity': '81'}
+
+
+# generator arguments: a random config for required ones (tuning)
+def generator_args(gen, flags_file):
+    code, defaults = gen.func.func_code, gen.func.func_defaults or ()
+    required = code.co_argcount - len(defaults)
+    if not required: return []
+    flags = xplfl.opt_flag_list(flags_file).flags
+    rng = random.Random(0)
+    config = ' '.join([f.level_str(rng.randrange(f.levels())) for f in
+                       rng.sample(flags, min(len(flags), 16))])
+    return [generator_values.get(name, config)
+            for name in code.co_varnames[:required]]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values and values[min(len(values) - 1,
+                                 int(len(values) * pct / 100.0))] or 0
+
+
+# run one case in this process, returns its measures
+def run_case(case):
+    gen = dict([(g.func.func_name, g) for g in
+                xplfl.generator.generators])[case['generator']]
+    if case['generator'] == 'gen_surrogate' and not xplfl.numpy:
+        return dict(case, skipped='numpy not available')
+    xplfl.runner.dryrun_output = staticmethod(
+        objectives.output(case['objective']))
+    xplfl.metrics.setup()
+    xplfl.results.setup()
+    xplfl.runner.setup(jobs=case['jobs'], dryrun=True,
+                       engine=case['engine'])
+    xplfl.cache.setup(no_cache=case['no_cache'])
+    xplfl.failures.setup()
+    xplfl.journal.setup(seed=0)
+    start = time.time()
+    xplfl.exploration.setup(
+        generator=gen(*generator_args(gen, case['flags'])),
+        flags_list=case['flags'], seed=0)
+    setup_time = time.time() - start
+    # exploration.loop, timed, and stopped after the given configs
+    latencies, flags_time, gen_time, configs, result = [], 0.0, 0.0, 0, None
+    start = time.time()
+    while configs < case['configs']:
+        t0 = time.time()
+        try: config = xplfl.exploration.generator.send(result)
+        except StopIteration: break
+        gen_time += time.time() - t0
+        batch = xplfl.exploration.is_batch(config)
+        result = []
+        for c in (config if batch else [config]):
+            t0 = time.time()
+            flags = xplfl.exploration.flags(c)
+            t1 = time.time()
+            result.append(xplfl.runner.start(
+                    flags, xplfl.exploration.fidelity))
+            t2 = time.time()
+            flags_time += t1 - t0
+            latencies.append(t2 - t0)
+            configs += 1
+        if not batch: result = result[0]
+    xplfl.runner.finalize()
+    elapsed = time.time() - start
+    runs = len([r for r in xplfl.results.results.values() if r > 0])
+    return dict(
+        case, configs=configs, runs=runs, setup_time=setup_time,
+        time=elapsed, throughput=configs / max(elapsed, 1e-9),
+        generator_time=gen_time, flags_time=flags_time,
+        latency_mean=sum(latencies) / max(len(latencies), 1),
+        latency_p50=percentile(latencies, 50),
+        latency_p99=percentile(latencies, 99),
+        latency_max=max(latencies or [0]),
+        maxrss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+# run one case in a new process, so that peak memory is its own
+def spawn_case(case):
+    p = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--case',
+         json.dumps(case)], stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode: return dict(case, error=p.returncode)
+    return json.loads(out.strip().split('\n')[-1])
+
+
+# ####################################################################
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(
+        description='Benchmark exploration engine overhead on dryruns',
+        usage='Usage: %prog [options]')
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser.add_option(
+        '--generators', dest='generators', default=None,
+        help='comma separated list of generators (default: all)')
+    parser.add_option(
+        '--flags', dest='flags', default=','.join([
+                os.path.join(root_dir, f) for f in [
+                    'flags_gcc_54_test.txt', 'flags_gcc_63_small.txt',
+                    'flags_llvm_38_small.txt']]),
+        help='comma separated list of flags files (default: shipped ones)')
+    parser.add_option(
+        '--large-flags', dest='large_flags', default='2000',
+        help='comma separated sizes of generated flags lists '
+        '(default: 2000)')
+    parser.add_option(
+        '--jobs', dest='jobs', default='1,8',
+        help='comma separated list of -j values (default: 1,8)')
+    parser.add_option(
+        '--engines', dest='engines', default='threads',
+        help='comma separated list of engines (default: threads)')
+    parser.add_option(
+        '--objectives', dest='objectives', default=','.join(objectives.names),
+        help='comma separated list of synthetic objectives '
+        '(default: %s)' % ','.join(objectives.names))
+    parser.add_option(
+        '--configs', dest='configs', type=int, default=200,
+        help='max number of configs per case (default: 200)')
+    parser.add_option(
+        '--no-cache', dest='no_cache', action='store_true', default=False,
+        help='disable results cache (default: False)')
+    parser.add_option(
+        '--output', dest='output', default=None,
+        help='json lines output file (default: stdout)')
+    parser.add_option('--case', dest='case', help=optparse.SUPPRESS_HELP)
+
+    (opts, args) = parser.parse_args()
+
+    if opts.case:
+        # results of runs are printed on stdout: keep it for measures
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        print >>stdout, json.dumps(run_case(json.loads(opts.case)))
+        sys.exit(0)
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-engine.')
+    flags_files = filter(None, opts.flags.split(',')) + [
+        generate_flags(int(n), tmp_dir) for n in
+        filter(None, opts.large_flags.split(','))]
+    generators = opts.generators and opts.generators.split(',') or [
+        g.func.func_name for g in xplfl.generator.generators]
+    output = opts.output and open(opts.output, 'w') or sys.stdout
+    try:
+        for (gen, flags, jobs, engine, objective) in itertools.product(
+            generators, flags_files, opts.jobs.split(','),
+            opts.engines.split(','), opts.objectives.split(',')):
+            case = {'generator': gen, 'flags': flags, 'jobs': int(jobs),
+                    'engine': engine, 'objective': objective,
+                    'configs': opts.configs, 'no_cache': opts.no_cache}
+            case['nflags'] = len(xplfl.opt_flag_list(flags).flags)
+            print >>output, json.dumps(spawn_case(case), sort_keys=True)
+            output.flush()
+    finally:
+        for f in os.listdir(tmp_dir): os.remove(os.path.join(tmp_dir, f))
+        os.rmdir(tmp_dir)
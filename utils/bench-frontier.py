@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import os, sys, time, random, optparse, importlib.util
+
+
+# graph-tmp.py is not importable by name
+spec = importlib.util.spec_from_file_location(
+    'graph_tmp', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'graph-tmp.py'))
+graph_tmp = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(graph_tmp)
+
+
+# ####################################################################
+
+def naive_frontier(coords):
+    # reference pairwise algorithm (previous compute_frontier)
+    return [i for (i, c1) in enumerate(coords) if not any(
+        all(a > b for (a, b) in zip(c2, c1)) for c2 in coords)]
+
+
+def random_coords(rng, n, dims):
+    return [tuple(rng.gauss(0, 10) for d in range(dims)) for i in range(n)]
+
+
+def file_coords(resfile, refid=None):
+    opts = optparse.Values({'follow': False, 'refid': refid})
+    cases = graph_tmp.optcases(resfile, opts)
+    cases.update()
+    return [(c.speedup, c.sizered) for c in cases.results]
+
+
+def timed(func, coords):
+    start = time.time()
+    res = func(coords)
+    return time.time() - start, res
+
+
+def bench(name, coords, naive_max):
+    dims = len(coords[0])
+    algos = [('kd', graph_tmp.frontier_kd)]
+    if dims == 2: algos.insert(0, ('2d', graph_tmp.frontier_2d))
+    if len(coords) <= naive_max: algos.append(('naive', naive_frontier))
+    timings = {}
+    for (algo, func) in algos:
+        timings[algo], res = timed(func, coords)
+        if 'ref' not in timings: ref = res
+        assert res == ref, 'frontier mismatch for %s' % algo
+        timings['ref'] = timings[algo]
+    del timings['ref']
+    print('%-20s n=%-8d k=%d frontier=%-5d %s' % (
+        name, len(coords), dims, len(ref), ' '.join(
+            '%s=%.3fs' % (algo, timings[algo]) for (algo, f) in algos)))
+    if 'naive' in timings:
+        print('%-20s speedup %s' % ('', ' '.join(
+            '%s=%.1fx' % (algo, timings['naive'] / max(timings[algo], 1e-6))
+            for (algo, f) in algos if algo != 'naive')))
+
+
+# ####################################################################
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(
+        description='Benchmark pareto frontier computations',
+        usage='Usage: %prog [options] [results...]')
+    parser.add_option(
+        '--sizes', dest='sizes', default='1000,10000,100000,1000000',
+        help='random point set sizes (default: 1000,10000,100000,1000000)')
+    parser.add_option(
+        '--dims', dest='dims', default='2,3',
+        help='random point set dimensions (default: 2,3)')
+    parser.add_option(
+        '--naive-max', dest='naive_max', type=int, default=10000,
+        help='max size for the pairwise reference (default: 10000)')
+    parser.add_option(
+        '--refid', dest='refid',
+        help='identifier of the reference run in results files')
+    parser.add_option(
+        '--seed', dest='seed', type=int, default=0,
+        help='random seed (default: 0)')
+
+    (opts, args) = parser.parse_args()
+
+    rng = random.Random(opts.seed)
+    for resfile in args:
+        bench(os.path.basename(resfile), file_coords(resfile, opts.refid),
+              opts.naive_max)
+    if args: sys.exit(0)
+    for dims in [int(d) for d in opts.dims.split(',')]:
+        for size in [int(n) for n in opts.sizes.split(',')]:
+            bench('random', random_coords(rng, size, dims), opts.naive_max)
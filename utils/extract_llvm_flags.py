@@ -1,77 +1,162 @@
 #!/usr/bin/env python
 
-import sys, os, textwrap, re
+import sys, os, re, json, optparse, multiprocessing
 
-# usage: extract_llvm_flags.py llvm_source_dir [old_llvm_flags_file]
+# usage: extract_llvm_flags.py [options] llvm_source_dir [old_llvm_flags_file]
 #   extracts available flags and parameters for llvm from its source files
+#   (files are scanned in parallel, and results of unchanged files are
+#   reused from the --cache file)
 
 
 # ####################################################################
 
-if len(sys.argv) < 2 or not all(map(os.path.exists, sys.argv[1:])):
-    print >>sys.stderr, 'usage: %s llvm_src_dir [old_llvm_flags_list]' % (
-        os.path.basename(sys.argv[0]))
-    sys.exit(1)
-
-old_flags = {}
-
-if len(sys.argv) > 2:
-    for line in open(sys.argv[2]):
-        re_obj = re.match('#?\s*-mllvm -([^=]*)=', line)
-        if not re_obj:
-            continue
-        old_flags[re_obj.group(1)] = line
-
-root_dir = sys.argv[1]
-for dir_name, subdir_list, file_list in os.walk(root_dir):
-    for f in file_list:
-        if not f.lower().endswith('.cpp'): continue
-        llvm_file = os.path.join(dir_name, f)
-        cl_opt = None
-        for line in open(llvm_file):
-            if '//' in line: line = line[:line.find('//')]
-            line = line.strip()
-            if not cl_opt:
-                if line.startswith('static cl::opt<') or line.startswith('cl::opt<'):
-                    cl_opt = line
-            else: cl_opt += ' ' + line
-            if cl_opt and cl_opt[-1] == ';':
-                line = str(cl_opt)
-                cl_opt = None
-
-                # flag
-                re_obj = re.search('cl::opt<.*>\s*\w*\(\s*"([^"]*)', line)
-                if not re_obj: continue
-                flag_str = str(re_obj.group(1))
-                # file
-                flag_file = llvm_file
-                # type
-                re_obj = re.search('cl::opt<([^,>]*)', line)
-                assert re_obj
-                flag_type = str(re_obj.group(1))
-                # name
-                re_obj = re.search('cl::opt<.*>\s*(\w*)\(', line)
-                assert re_obj
-                flag_name = str(re_obj.group(1))
-                # desc
-                re_obj = re.search('desc\(([^)]*)\)', line)
-                flag_desc = re_obj and str(re_obj.group(1).strip()[1:-1]) or ""
-                # init
-                re_obj = re.search('init\(([^)]*)\)', line)
-                flag_init = re_obj and str(re_obj.group(1).strip()) or ""
-
-                print '#', '-%s' % flag_str, '(%s)' % (flag_file)
-                print '#  ', flag_name, '-', flag_desc
-                print '#  ', flag_type, '(default: %s)' % flag_init
-
-                if flag_str in old_flags:
-                    print '# XXX-KNOWN', old_flags[flag_str],
-                elif flag_type == 'bool':
-                    print '# XXX-BOOL -mllvm -%s=true|-mllvm -%s=false' % (flag_str, flag_str)
-                elif flag_type in ['uint32_t', 'unsigned']:
-                    print '# XXX-UINT -mllvm -%s=[%s..%s]' % (flag_str, flag_init, flag_init)
-                elif flag_type in ['int', 'signed']:
-                    print '# XXX-SINT -mllvm -%s=[%s..%s]' % (flag_str, flag_init, flag_init)
-                else:
-                    print '# XXX-OTHER -mllvm -%s=%s' % (flag_str, flag_init)
-                print
+re_flag = re.compile('cl::opt<.*>\s*\w*\(\s*"([^"]*)')
+re_type = re.compile('cl::opt<([^,>]*)')
+re_name = re.compile('cl::opt<.*>\s*(\w*)\(')
+re_desc = re.compile('desc\(([^)]*)\)')
+re_init = re.compile('init\(([^)]*)\)')
+
+
+# [(flag_str, flag_file, flag_type, flag_name, flag_desc, flag_init)]
+# of the cl::opt declarations of a source file
+def scan_file(llvm_file):
+    data = open(llvm_file, 'rb').read()
+    # most files have no option: skip them without parsing lines
+    if 'cl::opt<' not in data: return []
+    flags, cl_opt = [], None
+    for line in data.split('\n'):
+        if '//' in line: line = line[:line.find('//')]
+        line = line.strip()
+        if not cl_opt:
+            if line.startswith('static cl::opt<') or line.startswith('cl::opt<'):
+                cl_opt = line
+        else: cl_opt += ' ' + line
+        if cl_opt and cl_opt[-1] == ';':
+            line = str(cl_opt)
+            cl_opt = None
+
+            # flag
+            re_obj = re_flag.search(line)
+            if not re_obj: continue
+            flag_str = str(re_obj.group(1))
+            # type
+            re_obj = re_type.search(line)
+            assert re_obj
+            flag_type = str(re_obj.group(1))
+            # name
+            re_obj = re_name.search(line)
+            assert re_obj
+            flag_name = str(re_obj.group(1))
+            # desc
+            re_obj = re_desc.search(line)
+            flag_desc = re_obj and str(re_obj.group(1).strip()[1:-1]) or ""
+            # init
+            re_obj = re_init.search(line)
+            flag_init = re_obj and str(re_obj.group(1).strip()) or ""
+
+            flags.append(
+                (flag_str, llvm_file, flag_type, flag_name, flag_desc,
+                 flag_init))
+    return flags
+
+
+# (path, mtime, size) of source files, in os.walk order
+def source_files(root_dir):
+    for dir_name, subdir_list, file_list in os.walk(root_dir):
+        for f in file_list:
+            if not f.lower().endswith('.cpp'): continue
+            llvm_file = os.path.join(dir_name, f)
+            st = os.stat(llvm_file)
+            yield llvm_file, st.st_mtime, st.st_size
+
+
+def print_flag(flag, old_flags):
+    flag_str, flag_file, flag_type, flag_name, flag_desc, flag_init = flag
+
+    print '#', '-%s' % flag_str, '(%s)' % (flag_file)
+    print '#  ', flag_name, '-', flag_desc
+    print '#  ', flag_type, '(default: %s)' % flag_init
+
+    if flag_str in old_flags:
+        print '# XXX-KNOWN', old_flags[flag_str],
+    elif flag_type == 'bool':
+        print '# XXX-BOOL -mllvm -%s=true|-mllvm -%s=false' % (flag_str, flag_str)
+    elif flag_type in ['uint32_t', 'unsigned']:
+        print '# XXX-UINT -mllvm -%s=[%s..%s]' % (flag_str, flag_init, flag_init)
+    elif flag_type in ['int', 'signed']:
+        print '# XXX-SINT -mllvm -%s=[%s..%s]' % (flag_str, flag_init, flag_init)
+    else:
+        print '# XXX-OTHER -mllvm -%s=%s' % (flag_str, flag_init)
+    print
+
+
+# ####################################################################
+
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(
+        description='Extract llvm flags from its source files',
+        usage='Usage: %prog [options] llvm_src_dir [old_llvm_flags_list]')
+    parser.add_option(
+        '-j', '--jobs', dest='jobs', type=int,
+        default=multiprocessing.cpu_count(),
+        help='number of parallel scanning processes (default: cpu count)')
+    parser.add_option(
+        '--cache', dest='cache_file', default=None,
+        help='per-file results cache, keyed by path, mtime and size '
+        '(default: None)')
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) < 1 or not all(map(os.path.exists, args)):
+        print >>sys.stderr, 'usage: %s llvm_src_dir [old_llvm_flags_list]' % (
+            os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    old_flags = {}
+
+    if len(args) > 1:
+        for line in open(args[1]):
+            re_obj = re.match('#?\s*-mllvm -([^=]*)=', line)
+            if not re_obj:
+                continue
+            old_flags[re_obj.group(1)] = line
+
+    # {path: [mtime, size, flags]} of a previous extraction (strings are
+    # saved as latin-1, keeping source bytes as they are)
+    cache = {}
+    if opts.cache_file and os.path.exists(opts.cache_file):
+        try: cache = json.load(open(opts.cache_file), encoding='latin-1')
+        except ValueError: pass
+        cache = dict([
+                (path.encode('latin-1'), [mtime, size, [
+                            [s.encode('latin-1') for s in flag]
+                            for flag in flags]])
+                for (path, (mtime, size, flags)) in cache.items()])
+
+    files = list(source_files(args[0]))
+    changed = [path for (path, mtime, size) in files
+               if cache.get(path, [None, None])[:2] != [mtime, size]]
+    print >>sys.stderr, '%d files, %d to scan' % (len(files), len(changed))
+
+    if changed:
+        pool = multiprocessing.Pool(max(opts.jobs, 1))
+        scanned = pool.map(scan_file, changed, chunksize=16)
+        pool.close()
+        pool.join()
+        cache.update(dict(
+                [(path, [None, None, flags]) for (path, flags) in
+                 zip(changed, scanned)]))
+
+    # only entries of current files are kept
+    cache = dict([(path, [mtime, size, cache[path][2]])
+                  for (path, mtime, size) in files])
+
+    for (path, mtime, size) in files:
+        for flag in cache[path][2]:
+            print_flag(flag, old_flags)
+
+    if opts.cache_file:
+        with open(opts.cache_file + '.tmp', 'w') as stream:
+            json.dump(cache, stream, encoding='latin-1')
+        os.rename(opts.cache_file + '.tmp', opts.cache_file)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import sys, re, math, operator, optparse, itertools, signal
+import os, sys, re, math, operator, optparse, itertools, signal
+import numpy
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -47,6 +48,7 @@ colors = {
     'frontier': '#e6007e', 'selected': '#e6007e',
     'reflines': '#03234b', 'grid': '#3cb4e6', 'title': '#03234b', 'face': '#f1f1f3',
     'highlight': ['#ffd200', '#e6007e', '#8c0078', '#49b170', '#03234b'],
+    'density': ['#3cb4e6', '#03234b'],
 }
 
 
@@ -66,6 +68,10 @@ attrmaps = {
         's': 30, 'linewidth': 1, 'alpha': 1.0, 'label': '_nolegend_', 'zorder': 2 },
     'highlight': {
         'edgecolor': colors['default-edg'], 's': 40, 'alpha': 1.0, 'zorder': 4 },
+    'density': {
+        'cmap': matplotlib.colors.LinearSegmentedColormap.from_list(
+            'density', colors['density']),
+        'norm': matplotlib.colors.LogNorm(), 'zorder': 2 },
     'tradeoff-pt': {
         'markersize': 20, 'linewidth': 0, 'label': '_nolegend_', 'alpha': 0.4 },
     'tradeoff-ln': {
@@ -80,12 +86,14 @@ attrmaps = {
 
 # ####################################################################
 
-def draw_graph(getgraph, opts):
+def draw_graph(graph, opts):
     fg = plt.figure()
     ax = fg.add_subplot(111)
 
-    global graph_plots, all_points
-    graph_plots, all_points = [], []
+    global graph_plots, all_points, points_index
+    graph_plots, all_points = {}, []
+    # nearest points index, built on first click after points changes
+    points_index = None
 
     def draw_tradeoff_plots(ratio, points, attrs):
         # select tradeoff given ratio
@@ -110,60 +118,100 @@ def draw_graph(getgraph, opts):
         plots.append(((crds[0], crds[1]), dict(attrs)))
         return plots
 
+    def draw_density(points):
+        # 2d histogram of points, for too many points to scatter
+        xy = numpy.array([(p.sizered, p.speedup) for p in points])
+        if opts.density == 'hist2d':
+            gr = ax.hist2d(xy[:, 0], xy[:, 1], bins=opts.gridsize, cmin=1,
+                           **attrmaps['density'])[3]
+        else:
+            gr = ax.hexbin(xy[:, 0], xy[:, 1], gridsize=opts.gridsize,
+                           mincnt=1, **attrmaps['density'])
+        fg.colorbar(gr, ax=ax, label='POINTS')
+        return gr
+
     def draw_all():
-        global graph_plots, all_points, selected_points  # :(
+        global graph_plots, all_points, points_index, selected_points  # :(
+
+        # get new points, only appended ones when following
+        reset, new_points = graph.update()
+        if not reset and not new_points: return
 
-        # remove old plots
-        old_points = [(p.sizered, p.speedup, p.variant) for p in all_points]
-        for x in list(graph_plots):
-            graph_plots.remove(x)
-            x.remove()
+        # remove old plots if results file was reloaded
+        if reset:
+            for x in list(graph_plots.values()):
+                x.remove()
+            graph_plots = {}
+            ax.ignore_existing_data_limits = True
 
         # get graph values
-        scatters, plots = getgraph()
-        all_points = sum([x[0] for x in scatters + plots], [])
+        scatters, plots = graph.graph()
+        all_points = graph.points()
+        points_index = None
+
+        def update_plot(key, xy, create):
+            # update plot data in place or create it
+            if key in graph_plots:
+                graph_plots[key].set_data(*xy)
+            else:
+                graph_plots[key], = create()
+            return graph_plots[key]
+
+        # draw points density in batch mode if too many points
+        density = opts.batch and len(all_points) > opts.density_threshold
+        if density:
+            graph_plots['density'] = draw_density(all_points)
 
         # draw scatters
-        for (points, attrs) in scatters:
-            xy = list(zip(*[(p.sizered, p.speedup) for p in points]))
-            gr = ax.scatter(*xy, **attrs)
-            graph_plots.append(gr)
+        new_scatter = False
+        for (n, (points, attrs)) in enumerate(scatters):
+            if not points: continue
+            # not highlighted points (last scatter) are in density
+            if density and n == len(scatters) - 1: continue
+            xy = [(p.sizered, p.speedup) for p in points]
+            if ('scatter', n) in graph_plots:
+                graph_plots[('scatter', n)].set_offsets(xy)
+            else:
+                gr = ax.scatter(*zip(*xy), **attrs)
+                graph_plots[('scatter', n)] = gr
+                new_scatter = True
 
         # draw line plots (frontiers)
-        for (points, attrs) in plots:
+        for (n, (points, attrs)) in enumerate(plots):
+            if not points: continue
             xy = list(zip(*sorted([(p.sizered, p.speedup) for p in points])))
-            gr, = ax.plot(xy[0], xy[1], **attrs)
-            graph_plots.append(gr)
+            update_plot(('plot', n), xy, lambda: ax.plot(
+                xy[0], xy[1], **attrs))
 
             # show tradeoffs for each frontier
             for ratio in opts.tradeoffs or []:
-                for ((xcrd, ycrd), attrs) in draw_tradeoff_plots(
-                        ratio, points, dict(attrs)):
-                    graph_plots.append(ax.plot(xcrd, ycrd, **attrs)[0])
-
-        # draw selected points (hidden)
-        if all_points:
-            # workaround pb with pick_event event ind (4000)
-            xy = list(zip(*sorted([(p.sizered, p.speedup) for p in all_points])))
+                for (m, ((xcrd, ycrd), tattrs)) in enumerate(
+                        draw_tradeoff_plots(ratio, points, dict(attrs))):
+                    update_plot(('tradeoff', n, ratio, m), (xcrd, ycrd),
+                                lambda: ax.plot(xcrd, ycrd, **tattrs))
+
+        # selected point (hidden until a point is clicked)
+        if 'selected' not in graph_plots:
             selected_points, = ax.plot(
-                xy[0], xy[1], visible=False, picker=4000, **attrmaps['selected'])
-            graph_plots.append(selected_points)
+                [], [], visible=False, **attrmaps['selected'])
+            graph_plots['selected'] = selected_points
 
         # highlight new points
-        if opts.follow and old_points:
-            new_points = list(filter(
-                lambda p: (p.sizered, p.speedup, p.variant) not in old_points,
-                all_points))
-            if new_points:
-                xy = list(zip(*[(p.sizered, p.speedup) for p in new_points]))
-                new_points, = ax.plot(*xy, **attrmaps['new-pt'])
-                graph_plots.append(new_points)
+        if opts.follow and not reset:
+            xy = list(zip(*[(p.sizered, p.speedup) for p in new_points]))
+            update_plot('new-pt', xy, lambda: ax.plot(
+                *xy, **attrmaps['new-pt']))
+
+        # rescale on appended points
+        if not reset:
+            ax.update_datalim([(p.sizered, p.speedup) for p in new_points])
+            ax.autoscale_view()
 
         # redraw legend and figure
         if opts.xlim: plt.xlim([float(l) for l in opts.xlim.split(',')])
         if opts.ylim: plt.ylim([float(l) for l in opts.ylim.split(',')])
-        ax.legend(loc='lower left')
-        fg.canvas.draw()
+        if reset or new_scatter: ax.legend(loc='lower left')
+        fg.canvas.draw_idle()
 
     # https://stackoverflow.com/a/42014041
     def get_aspect_ratio():
@@ -179,25 +227,21 @@ def draw_graph(getgraph, opts):
         return disp_ratio / data_ratio
 
     # dynamic annotations
-    def on_pick(event):
+    def on_click(event):
         def closest(x, y):
-            r = get_aspect_ratio()
-            dp = sorted([(math.hypot(
-                (p.sizered - x) / r, p.speedup - y), p) for p in all_points],
-                        key=operator.itemgetter(0))
-            distmin, closest = dp[0]
-            closests = set(
-                map(operator.itemgetter(1), filter(lambda d_p: d_p[0] == distmin, dp)))
+            global points_index
+            if points_index is None: points_index = pointsindex(all_points)
+            closests = points_index.nearest(x, y, get_aspect_ratio())
             for (n, point) in enumerate(closests):
                 # print point on console
                 print( '-' * 20, n )
                 print( point_str(point) )
-            return closest
+            return closests[0]
 
         def highlight(p):
             # highlight point
             selected_points.set_visible(True)
-            selected_points.set_data(p.sizered, p.speedup)
+            selected_points.set_data([p.sizered], [p.speedup])
             # selected point legend
             main_legend = ax.legend_
             lg = point_str(p, short=True)
@@ -207,8 +251,11 @@ def draw_graph(getgraph, opts):
             fg.canvas.draw()
             ax.legend_ = main_legend
 
-        print( '#' * 20, event.mouseevent.xdata, event.mouseevent.ydata )
-        highlight(closest(event.mouseevent.xdata, event.mouseevent.ydata))
+        # ignore clicks outside of graph or while zooming/panning
+        if event.inaxes is not ax or not all_points: return
+        if getattr(fg.canvas.toolbar, 'mode', ''): return
+        print( '#' * 20, event.xdata, event.ydata )
+        highlight(closest(event.xdata, event.ydata))
 
     # live plotting
     def on_timer(): draw_all()
@@ -249,7 +296,8 @@ def draw_graph(getgraph, opts):
     fg.tight_layout()
     if opts.outfile:
         fg.savefig(opts.outfile)
-    fg.canvas.mpl_connect('pick_event', on_pick)
+    if opts.batch: return
+    fg.canvas.mpl_connect('button_press_event', on_click)
     if opts.follow:
         timer = repeatalarm(on_timer, 1.0).start()
     plt.show()
@@ -271,6 +319,9 @@ def point_str(point, short=False):
 
 
 class point:
+    __slots__ = ('variant', 'time', 'size', 'flags',
+                 'speedup', 'sizered', 'on_frontier')
+
     def __init__(self, time, size, variant, flags=None):
         self.variant = variant
         self.time = time
@@ -280,6 +331,57 @@ class point:
         self.sizered = None
 
 
+class pointsindex:
+    # 2-d tree of points coordinates for nearest point queries
+    # points are partitioned in place around medians, alternating axes
+
+    leaf_size = 16
+
+    def __init__(self, points):
+        self.points = list(points)
+        self.xy = numpy.array(
+            [(p.sizered, p.speedup) for p in self.points], dtype=float
+        ).reshape(-1, 2)
+        self.index = numpy.arange(len(self.points))
+        self.split = numpy.zeros(len(self.points))  # by node middle
+        self.build(0, len(self.points), 0)
+
+    def build(self, lo, hi, axis):
+        if hi - lo <= self.leaf_size: return
+        mid = (lo + hi) // 2
+        sub = self.index[lo:hi]
+        self.index[lo:hi] = sub[numpy.argpartition(
+            self.xy[sub, axis], mid - lo)]
+        self.split[mid] = self.xy[self.index[mid], axis]
+        self.build(lo, mid, 1 - axis)
+        self.build(mid, hi, 1 - axis)
+
+    def nearest(self, x, y, ratio=1.0):
+        # closest points given x axis scaled down by ratio, O(log n)
+        if not self.points: return []
+        query, scale = numpy.array([x, y]), numpy.array([ratio, 1.0])
+        best = [numpy.inf, []]
+
+        def search(lo, hi, axis):
+            if hi - lo <= self.leaf_size:
+                idx = self.index[lo:hi]
+                dist = numpy.hypot(*((self.xy[idx] - query) / scale).T)
+                dmin = dist.min()
+                if dmin < best[0]: best[:] = [dmin, []]
+                if dmin == best[0]: best[1].extend(idx[dist == dmin])
+                return
+            # left part coordinates <= split <= right part coordinates
+            mid = (lo + hi) // 2
+            diff = (query[axis] - self.split[mid]) / scale[axis]
+            near, far = ((lo, mid), (mid, hi))
+            if diff >= 0: near, far = far, near
+            search(near[0], near[1], 1 - axis)
+            if abs(diff) <= best[0]: search(far[0], far[1], 1 - axis)
+
+        search(0, len(self.points), 0)
+        return [self.points[i] for i in sorted(best[1])]
+
+
 def select_tradeoff(frontier, perf_size_ratio=4):
     if not frontier: return None
     # speedups must be already computed
@@ -295,75 +397,171 @@ def select_tradeoff(frontier, perf_size_ratio=4):
     return tradeoffs[-1][1]
 
 
+def frontier_2d(coords):
+    # indexes of the points not strictly dominated on both coordinates
+    # (higher is better), sort and sweep in O(n log n)
+    coords = numpy.asarray(coords, dtype=float)
+    if not len(coords): return []
+    order = numpy.argsort(-coords[:, 0], kind='stable')
+    xs, ys = -coords[order, 0], coords[order, 1]
+    # best y among points of strictly higher x (before x group start)
+    ymax = numpy.maximum.accumulate(ys)
+    start = numpy.searchsorted(xs, xs, side='left')
+    above = numpy.where(start > 0, ymax[start - 1], -numpy.inf)
+    return sorted(int(i) for i in order[ys >= above])
+
+
+def frontier_kd(coords, chunk=1024):
+    # indexes of the points not strictly dominated on all k coordinates
+    # a dominating point has a higher sum: points are visited by
+    # decreasing sum and compared to the frontier found so far only
+    coords = numpy.asarray(coords, dtype=float)
+    if not len(coords): return []
+    order = numpy.argsort(-coords.sum(axis=1), kind='stable')
+    frontier = numpy.empty((0, coords.shape[1]))
+    indexes = []
+    for start in range(0, len(order), chunk):
+        # filter chunk against current frontier at once
+        idx = order[start:start + chunk]
+        dominated = (frontier[None, :, :] > coords[idx][:, None, :]).all(
+            axis=2).any(axis=1)
+        new = []
+        for i in idx[~dominated]:
+            if any((coords[j] > coords[i]).all() for j in new): continue
+            new.append(i)
+        frontier = numpy.vstack([frontier, coords[new]])
+        indexes.extend(new)
+    return sorted(int(i) for i in indexes)
+
+
 def compute_frontier(results):
-    maybe_on_frontier, mustbe_on_frontier = list(results), set()
+    coords = [(c.speedup, c.sizered) for c in results]
+    for c in results: c.on_frontier = False
+    for i in frontier_2d(coords): results[i].on_frontier = True
+
+
+def update_frontier(frontier, results):
+    # add new results to an existing frontier, returns the new frontier
+    # a point dominated by any point is dominated by a frontier point
+    frontier = list(frontier)
     for c1 in results:
-        on_frontier = True
-        maybe_on_frontier.remove(c1)
-        for c2 in itertools.chain(mustbe_on_frontier, maybe_on_frontier):
-            if (c2.speedup == c1.speedup and c2.sizered == c1.sizered):
-                pass
-            elif c2.speedup > c1.speedup and c2.sizered > c1.sizered:
-                on_frontier = False
-                break
-        if on_frontier: mustbe_on_frontier.add(c1)
-        c1.on_frontier = on_frontier
+        c1.on_frontier = not any(
+            c2.speedup > c1.speedup and c2.sizered > c1.sizered
+            for c2 in frontier)
+        if not c1.on_frontier: continue
+        for c2 in frontier:
+            if c1.speedup > c2.speedup and c1.sizered > c2.sizered:
+                c2.on_frontier = False
+        frontier = [c2 for c2 in frontier if c2.on_frontier] + [c1]
+    return frontier
+
 
+class optcases:
+    # results file points, loaded incrementally
+    # (only the lines appended since the last update are parsed)
 
-def getoptcases(resfile, opts):
-    results = []
-    for line in open(resfile):
+    def __init__(self, resfile, opts):
+        self.resfile, self.opts = resfile, opts
+        self.reset()
+
+    def reset(self):
+        self.offset, self.ref = 0, None
+        self.results, self.waiting, self.frontier = [], [], []
+
+    @staticmethod
+    def parse_line(line):
         words = line.strip().split(';')
         time = float(words[2])
         size = float(words[3])
         variant = words[1]
         flags = words[0][1:-1]
-        results.append(point(time, size, variant, flags))
-    if opts.refid:
-        refres = list(
-            filter(lambda p: p.variant == opts.refid, results))
-        assert refres
-        ref = refres[0]
-    else: # ref by default is the 1st point
-        ref = results[0]
-    for res in results:
-        res.speedup = 100. * ((float(ref.time) / float(res.time)) - 1.0)
-        res.sizered = 100. * (1.0 - (float(res.size) / float(ref.size)))
-    compute_frontier(results)
-    print( 'n=%d' % len(results) )
-    return results
-
-
-def optgraph(opts):
-    optcases = getoptcases(opts.resfile, opts)
-    scatters, plots = [], []
-
-    # scatters definition
-    scatters_def = []
-    for (n, high_def) in enumerate(opts.highlight):
-        high_reg, high_leg = (
-            high_def.split(',') if (',' in high_def) else (high_def, '_nolegend_'))
-        attrs = dict(attrmaps['highlight'])
-        attrs.update({
-            'label': high_leg,
-            'color': colors['highlight'][n % len(colors['highlight'])]})
-        scatters_def.append((high_reg, attrs))
-    scatters_def.append(('.*', attrmaps['scatter-def']))
-
-    # scatters list - partionning points into scatters
-    partitions, attrs_values = {}, dict(scatters_def)
-    for c in optcases:
-        for (opt, val) in scatters_def:
-            if not re.match(opt, c.variant): continue
-            partitions.setdefault(opt, []).append(c)
-            break
-    partkeys = [x[0] for x in scatters_def if x[0] in partitions.keys()]
-    scatters = list(map(lambda opt: (partitions[opt], attrs_values[opt]), partkeys))
-
-    # frontier line
-    plots.append(([c for c in optcases if c.on_frontier], attrmaps['frontier']))
-
-    return scatters, plots
+        return point(time, size, variant, flags)
+
+    def read(self):
+        with open(self.resfile, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < self.offset:  # truncated file, reload
+                self.reset()
+            f.seek(self.offset)
+            data = f.read()
+        if self.opts.follow:  # incomplete last line is read next time
+            data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        return [self.parse_line(line)
+                for line in data.decode().splitlines() if line.strip()]
+
+    def update(self):
+        # returns (reset, new points), speedups and frontier updated
+        points = self.read()  # may reset
+        self.waiting.extend(points)
+        reset = not self.results
+        if self.ref is None:
+            if self.opts.refid:
+                refres = list(filter(
+                    lambda p: p.variant == self.opts.refid, self.waiting))
+                assert refres or self.opts.follow
+                self.ref = refres and refres[0] or None
+            else: # ref by default is the 1st point
+                self.ref = self.waiting and self.waiting[0] or None
+            if self.ref is None: return reset, []
+        ref, results, self.waiting = self.ref, self.waiting, []
+        for res in results:
+            res.speedup = 100. * ((float(ref.time) / float(res.time)) - 1.0)
+            res.sizered = 100. * (1.0 - (float(res.size) / float(ref.size)))
+        if not self.results:
+            compute_frontier(results)
+            self.frontier = [c for c in results if c.on_frontier]
+        else:
+            self.frontier = update_frontier(self.frontier, results)
+        self.results.extend(results)
+        if results: print( 'n=%d' % len(self.results) )
+        return reset, results
+
+
+class optgraph:
+    # points partitioned into highlight scatters, and frontier line
+
+    def __init__(self, opts):
+        self.cases = optcases(opts.resfile, opts)
+
+        # scatters definition
+        self.scatters_def = []
+        for (n, high_def) in enumerate(opts.highlight):
+            high_reg, high_leg = (
+                high_def.split(',') if (',' in high_def) else (high_def, '_nolegend_'))
+            attrs = dict(attrmaps['highlight'])
+            attrs.update({
+                'label': high_leg,
+                'color': colors['highlight'][n % len(colors['highlight'])]})
+            self.scatters_def.append((high_reg, attrs))
+        self.scatters_def.append(('.*', attrmaps['scatter-def']))
+        self.partitions = [[] for x in self.scatters_def]
+
+    def points(self):
+        return self.cases.results
+
+    def update(self):
+        reset, optcases = self.cases.update()
+        if reset: self.partitions = [[] for x in self.scatters_def]
+
+        # scatters list - partionning points into scatters
+        for c in optcases:
+            for (n, (opt, val)) in enumerate(self.scatters_def):
+                if not re.match(opt, c.variant): continue
+                self.partitions[n].append(c)
+                break
+        return reset, optcases
+
+    def graph(self):
+        # empty scatters are kept, so that indexes stay the same
+        # (last scatter holds the points not highlighted)
+        scatters = [(self.partitions[n], attrs) for (n, (opt, attrs))
+                    in enumerate(self.scatters_def)]
+
+        # frontier line
+        plots = [(self.cases.frontier, attrmaps['frontier'])]
+
+        return scatters, plots
 
 
 
@@ -402,9 +600,29 @@ if __name__ == '__main__':
     parser.add_option(
         '--outfile', dest='outfile',
         help='output file name')
+    #
+    parser.add_option(
+        '--batch', dest='batch', action='store_true', default=False,
+        help='only render graph in output file, without display')
+    parser.add_option(
+        '--density', dest='density', default='hexbin',
+        choices=['hexbin', 'hist2d'],
+        help='density rendering in batch mode: hexbin, hist2d (default: hexbin)')
+    parser.add_option(
+        '--density-threshold', dest='density_threshold', type=int,
+        default=100000,
+        help='number of points above which density is rendered (default: 100000)')
+    parser.add_option(
+        '--gridsize', dest='gridsize', type=int, default=100,
+        help='number of density bins along x axis (default: 100)')
 
     (opts, args) = parser.parse_args()
 
+    if opts.batch:
+        if not opts.outfile: parser.error('--batch requires --outfile')
+        if opts.follow: parser.error('--batch and --follow are exclusive')
+        plt.switch_backend('Agg')
+
     opts.resfile = args and args[0]
 
-    draw_graph(lambda: optgraph(opts), opts)
+    draw_graph(optgraph(opts), opts)
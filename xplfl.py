@@ -18,39 +18,827 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import os, sys, re, random, hashlib, optparse, logging, itertools
-import subprocess, threading, atexit, time, operator, shlex
+import os, sys, re, random, hashlib, optparse, logging, itertools, json, select
+import subprocess, threading, atexit, time, operator, shlex, collections
+import signal, socket, multiprocessing, bisect
 from logging import debug, info, warning, error
 
+try: import numpy
+except ImportError: numpy = None
+
 
 # ############################################################################
 
 class results():
 
+    # incremental pareto frontier of points minimizing all objectives
+    class pareto():
+
+        def __init__(self):
+            # points sorted by first objective [(values, item)]
+            self.keys, self.points = [], []
+
+        # insert a point, returns False if it is dominated
+        def insert(self, values, item):
+            if len(values) == 2: return self.insert_2d(values, item)
+            for (point, _) in self.points:
+                if all([p <= v for (p, v) in zip(point, values)]):
+                    return False
+            self.points = [(point, it) for (point, it) in self.points if not
+                           all([v <= p for (p, v) in zip(point, values)])]
+            i = bisect.bisect_left(
+                [point[0] for (point, _) in self.points], values[0])
+            self.points.insert(i, (values, item))
+            return True
+
+        # on a 2d frontier, second objective decreases with the first one:
+        # a new point can only be dominated by its predecessor, and can only
+        # dominate a contiguous range of its successors
+        def insert_2d(self, values, item):
+            x, y = values
+            i = bisect.bisect_left(self.keys, x)
+            if i and self.points[i - 1][0][1] <= y: return False
+            if i < len(self.keys) and (
+                self.keys[i] == x and self.points[i][0][1] <= y): return False
+            j = i
+            while j < len(self.points) and self.points[j][0][1] >= y: j += 1
+            self.keys[i:j] = [x]
+            self.points[i:j] = [(values, item)]
+            return True
+
     # run_id to result map {run_id: result}
+    # (-1 for failed runs, -2 for runs killed as dominated)
     results = {}
 
+    # run_id to objectives map {run_id: [(name, value)]}
+    objectives = {}
+
+    # [(name, weight)] of objectives summed as the result
+    weights = []
+
+    # frontier of named objectives (names given by the first run)
+    names, frontier, frontier_file = None, pareto(), None
+
     # used for locking result map
     lock = threading.Lock()
 
+    @staticmethod
+    def setup(objective=None, frontier_file=None, **kwargs):
+        results.weights = objective and [
+            (w.partition(':')[0], results.number(w.partition(':')[2] or '1'))
+            for w in objective.split(',')] or []
+        results.frontier_file = frontier_file
+
+    @staticmethod
+    def number(word):
+        try: return int(word)
+        except ValueError: return float(word)
+
+    # [(name, value)] given a "XRES value" or "XRES name=value ..." line
+    @staticmethod
+    def parse(xres):
+        words = xres.split()[1:]
+        if '=' not in words[0]: return [('res', results.number(words[0]))]
+        return [(n, results.number(v)) for (n, sep, v) in
+                [w.partition('=') for w in words]]
+
     # update results table given run command output
     @staticmethod
     def update(run_id, config, status, output):
-        res_lines = not status and filter(
-            lambda x: x.startswith('XRES'), output.splitlines())
-        try: res = int(res_lines[-1].split()[1])
-        except: res = -1
+        try:
+            objectives = status and [] or results.parse(output.xres)
+            values = dict(objectives)
+            if results.weights:
+                res = sum([w * values[n] for (n, w) in results.weights])
+            else: res = objectives[0][1]
+        except: res, objectives = -1, []
+        # results must stay positive (negative ones are failure codes)
+        if res <= 0 and objectives:
+            warning('non positive result %s of %s' % (res, run_id))
+            res, objectives = -1, []
+        if output.killed == 'dominated': res, objectives = -2, []
+        if res == -1 and output.tail:
+            debug('XFAIL %s exit=%s\n%s' % (
+                    run_id, status, '\n'.join(output.tail)))
+        results.add(run_id, config, res, objectives)
+        return res
+
+    # add a result to the results table
+    @staticmethod
+    def add(run_id, config, res, objectives=None):
         with results.lock:
-            debug('XRES %d %s %s' % (res, run_id, config))
+            debug('XRES %s %s %s' % (res, run_id, config))
             results.results.update({run_id: res})
-            print >>sys.stdout, 'XRES %d %s %s' % (res, run_id, config)
+            print >>sys.stdout, 'XRES %s %s %s' % (res, run_id, config)
             sys.stdout.flush()
+            if objectives:
+                results.objectives.update({run_id: objectives})
+                results.update_frontier(run_id, config, objectives)
+
+    @staticmethod
+    def update_frontier(run_id, config, objectives):
+        if results.names is None:
+            results.names = [n for (n, w) in results.weights] or [
+                n for (n, v) in objectives]
+        values = dict(objectives)
+        if len(results.names) < 2: return
+        if not all([n in values for n in results.names]): return
+        if not results.frontier.insert(
+            tuple([values[n] for n in results.names]), (run_id, config)):
+            return
+        info('XPARETO %d points, new %s %s' % (
+                len(results.frontier.points), run_id, ' '.join(
+                    ['%s=%s' % (n, values[n]) for n in results.names])))
+        if not results.frontier_file: return
+        # rewrite current frontier, atomically
+        with open(results.frontier_file + '.tmp', 'w') as stream:
+            for (point, (run_id, config)) in results.frontier.points:
+                print >>stream, run_id, ' '.join(
+                    ['%s=%s' % nv for nv in zip(results.names, point)]), config
+        os.rename(results.frontier_file + '.tmp', results.frontier_file)
+
+
+# ############################################################################
+
+class cache():
+
+    # config hash to result map {key: result}
+    entries = collections.OrderedDict()
+
+    # config hash to running run_id map {key: run_id}
+    pending = {}
+
+    # used for locking cache maps
+    lock = threading.Lock()
+
+    @staticmethod
+    def setup(no_cache=False, cache_size=0, cache_policy='lru',
+              cache_file=None, **kwargs):
+        cache.enabled = not no_cache
+        cache.size = cache_size
+        cache.policy = cache_policy
+        cache.stream = None
+        if not cache.enabled or not cache_file: return
+        # reload previous entries (skipping truncated lines)
+        if os.path.exists(cache_file):
+            for line in open(cache_file):
+                words = line.split()
+                if len(words) != 2: continue
+                try: cache.insert(words[0], results.number(words[1]))
+                except ValueError: continue
+        cache.stream = open(cache_file, 'a')
+
+    # canonical hash of normalized flags and run command (and fidelity)
+    @staticmethod
+    def key(config, fidelity=None):
+        flags = sorted(opt_flag_list.parse_line(config))
+        if fidelity is not None: flags += ['XFIDELITY', str(fidelity)]
+        return hashlib.sha1(
+            '\0'.join([runner.command] + flags)).hexdigest()
+
+    # hash of a binary hash (XHASH) and run command (and fidelity)
+    @staticmethod
+    def binary_key(xhash, fidelity=None):
+        words = [runner.command, 'XHASH', xhash]
+        if fidelity is not None: words += ['XFIDELITY', str(fidelity)]
+        return hashlib.sha1('\0'.join(words)).hexdigest()
+
+    # return (result, None) on hit, (None, run_id) if the same config is
+    # already running, (None, None) on miss (key is then marked pending)
+    @staticmethod
+    def lookup(key, run_id):
+        if not cache.enabled: return None, None
+        with cache.lock:
+            if key in cache.entries:
+                res = cache.entries[key]
+                if cache.policy == 'lru':
+                    del cache.entries[key]
+                    cache.entries[key] = res
+                return res, None
+            if key in cache.pending:
+                return None, cache.pending[key]
+            cache.pending[key] = run_id
+            return None, None
+
+    # forget a pending key without caching its result
+    @staticmethod
+    def discard(key):
+        with cache.lock:
+            cache.pending.pop(key, None)
+
+    @staticmethod
+    def insert(key, res):
+        if not cache.enabled: return
+        with cache.lock:
+            cache.pending.pop(key, None)
+            # failures may be transient: they are always run again
+            if res < 0: return
+            old_res = cache.entries.pop(key, None)
+            cache.entries[key] = res
+            # lru and fifo both evict from the head of the ordered map
+            while cache.size and len(cache.entries) > cache.size:
+                cache.entries.popitem(last=False)
+            # hits re-insert known results: only new ones are saved
+            if cache.stream and old_res != res:
+                print >>cache.stream, key, res
+                cache.stream.flush()
+
+
+# ############################################################################
+
+class journal():
+
+    # seed used by exploration, saved in journal header
+    seed = None
+
+    # runs of a previous session {seq: entry}
+    replay = {}
+
+    # used for locking journal file
+    lock = threading.Lock()
+
+    @staticmethod
+    def setup(journal_file=None, resume=False, seed=None, **kwargs):
+        assert journal_file or not resume, 'resume needs a journal file'
+        journal.seed = seed
+        journal.stream = None
+        journal.seq = 0
+        if not journal_file: return
+        # reload previous session (skipping truncated lines)
+        header = None
+        if resume and os.path.exists(journal_file):
+            for line in open(journal_file):
+                try: entry = json.loads(line)
+                except ValueError: continue
+                if 'seq' not in entry: header = entry
+                else: journal.replay.update({entry['seq']: entry})
+            info('resuming %d runs from %s' % (
+                    len(journal.replay), journal_file))
+        # a fixed seed is needed to replay the generator sequence
+        if header: journal.seed = header['seed']
+        elif journal.seed is None: journal.seed = random.getrandbits(32)
+        journal.stream = open(journal_file, header and 'a' or 'w')
+        if not header: journal.write({'seed': journal.seed})
+
+    @staticmethod
+    def write(entry):
+        with journal.lock:
+            print >>journal.stream, json.dumps(entry)
+            journal.stream.flush()
+            os.fsync(journal.stream.fileno())
+
+    # sequence number of a new run, given runs start order
+    @staticmethod
+    def new_seq():
+        journal.seq += 1
+        return journal.seq
+
+    # return entry of a finished run of the previous session if any
+    @staticmethod
+    def lookup(seq, config, fidelity=None):
+        entry = journal.replay.pop(seq, None)
+        if entry and (entry['config'], entry.get('fidelity')) != (
+            config, fidelity):
+            warning('journal mismatch on run %d, restarting it' % seq)
+            return None
+        return entry
+
+    @staticmethod
+    def record(seq, run_id, config, status, res, start, fidelity=None,
+               killed=None):
+        if not journal.stream: return
+        journal.write({
+            'seq': seq, 'run_id': run_id, 'config': config,
+            'fidelity': fidelity, 'status': status, 'res': res,
+            'killed': killed,
+            'objectives': results.objectives.get(run_id),
+            'start': start, 'end': time.time()})
+
+
+# ############################################################################
+
+class failures():
+
+    # known failing flags and flag pairs {frozenset([flag_str, ...])}
+    index = set()
+
+    # learned flags sets waiting for a confirmation run, and the ones
+    # not started yet
+    pending, unconfirmed = set(), []
+
+    # blame of suspected flags and flag pairs (never seen in a successful
+    # run) {frozenset([flag_str, ...]): blame}
+    suspects = collections.defaultdict(float)
+
+    # suspected flag pairs, per flag {flag_str: set([frozenset])}
+    suspect_pairs = collections.defaultdict(set)
+
+    # flags and flag pairs seen in successful runs (pairs of larger
+    # configs are only kept for suspected ones)
+    passed = set()
+
+    # max number of flags of configs giving suspected or passed pairs
+    # (pairs of larger configs are too many, and hardly pinpointed)
+    pairs_max_flags = 32
+
+    # used for locking failure maps
+    lock = threading.Lock()
+
+    @staticmethod
+    def setup(no_prune=False, failure_threshold=3, failures_file=None,
+              base_flags=None, **kwargs):
+        failures.prune = not no_prune
+        failures.threshold = failure_threshold
+        # base flags are never blamed
+        failures.base = set(opt_flag_list.parse_line(base_flags or ''))
+        # nothing is learned before a first successful run (failures of
+        # a broken run script or host are not the flags' fault)
+        failures.succeeded = False
+        failures.hits = 0
+        failures.stream = None
+        if not failures_file: return
+        # reload previous entries (skipping truncated lines)
+        if os.path.exists(failures_file):
+            for line in open(failures_file):
+                try: failures.index.add(frozenset(json.loads(line)))
+                except (ValueError, TypeError): continue
+            info('%d known failing flags sets' % len(failures.index))
+        failures.stream = open(failures_file, 'a')
+
+    # [frozenset] of flags (and flag pairs) of a config
+    @staticmethod
+    def subsets(flags, pairs=True):
+        return [frozenset([f]) for f in flags] + (pairs and [
+                frozenset(pair) for pair in
+                itertools.combinations(flags, 2)] or [])
+
+    # known failing flags set of a config if any
+    @staticmethod
+    def match(flags):
+        for subset in failures.index:
+            if subset <= flags: return subset
+        return None
+
+    @staticmethod
+    def lookup(config):
+        if not failures.prune or not failures.index: return None
+        flags = set(opt_flag_list.parse_line(config))
+        with failures.lock:
+            subset = failures.match(flags)
+            if subset: failures.hits += 1
+        return subset
+
+    # learn from a finished run: each failure not explained yet shares a
+    # blame among its flags never seen in a successful run, or else blames
+    # each of its such flag pairs (a given pair seldom recurs by chance),
+    # to be confirmed once reaching the threshold
+    @staticmethod
+    def learn(config, failed):
+        flag_set = set(opt_flag_list.parse_line(config)) - failures.base
+        flags = sorted(flag_set)
+        with failures.lock:
+            if not failed: failures.succeeded = True
+            elif not failures.succeeded: return
+            if not failed:
+                pairs = len(flags) <= failures.pairs_max_flags
+                for subset in failures.subsets(flags, pairs):
+                    failures.passed.add(subset)
+                    failures.suspects.pop(subset, None)
+                # suspected pairs of this config are cleared
+                for flag in flags:
+                    for pair in list(failures.suspect_pairs.get(flag, ())):
+                        if not pair <= flag_set: continue
+                        failures.passed.add(pair)
+                        failures.suspects.pop(pair, None)
+                        for f in pair: failures.suspect_pairs[f].discard(pair)
+                return
+            if failures.match(flag_set): return
+            suspects = [
+                subset for subset in failures.subsets(flags, False)
+                if subset not in failures.passed]
+            blame = 1.0 / max(len(suspects), 1)
+            if not suspects and len(flags) <= failures.pairs_max_flags:
+                suspects = [
+                    subset for subset in failures.subsets(flags)
+                    if len(subset) == 2 and subset not in failures.passed]
+                blame = 1.0
+            for subset in suspects:
+                if subset in failures.pending: continue
+                failures.suspects[subset] += blame
+                if len(subset) == 2:
+                    for f in subset: failures.suspect_pairs[f].add(subset)
+                if failures.suspects[subset] < failures.threshold: continue
+                debug('XSUSPECT %s' % ' | '.join(sorted(subset)))
+                failures.pending.add(subset)
+                failures.unconfirmed.append(subset)
+
+    # learned flags sets to be confirmed by a run of their own
+    @staticmethod
+    def confirmations():
+        with failures.lock:
+            subsets, failures.unconfirmed = failures.unconfirmed, []
+        return subsets
+
+    # result of the confirmation run of a learned flags set
+    @staticmethod
+    def confirmed(subset, res, killed):
+        with failures.lock:
+            failures.pending.discard(subset)
+            failures.suspects.pop(subset, None)
+            for f in subset: failures.suspect_pairs[f].discard(subset)
+            if res == -1 and not killed: failures.add(subset)
+
+    @staticmethod
+    def add(subset):
+        failures.index.add(subset)
+        info('XFAILURE %s' % ' | '.join(sorted(subset)))
+        if failures.stream:
+            print >>failures.stream, json.dumps(sorted(subset))
+            failures.stream.flush()
+
+
+# ############################################################################
+
+class metrics():
+
+    # histograms upper bounds, per observed value
+    buckets = {
+        'queue_wait_seconds': [0.001, 0.01, 0.1, 1, 10, 60, 600],
+        'spawn_seconds': [0.0001, 0.001, 0.01, 0.1, 1],
+        'exec_seconds': [0.1, 1, 10, 60, 300, 1800, 3600],
+        'generate_seconds': [0.0001, 0.001, 0.01, 0.1, 1, 10],
+        'output_bytes': [100, 1000, 10000, 100000, 1000000, 10000000],
+    }
+
+    # number of slowest runs kept
+    slowest_max = 10
+
+    # used for locking metrics
+    lock = threading.Lock()
+
+    @staticmethod
+    def setup(metrics_file=None, metrics_interval=10, **kwargs):
+        metrics.file, metrics.interval = metrics_file, metrics_interval
+        metrics.start = time.time()
+        metrics.counters = collections.defaultdict(int)
+        # {name: ([count per bucket, +inf last], sum)}
+        metrics.histograms = dict([
+                (name, ([0] * (len(bounds) + 1), 0.0))
+                for (name, bounds) in metrics.buckets.items()])
+        metrics.slowest = []  # [(seconds, run_id)], slowest last
+        metrics.busy, metrics.running = 0.0, 0
+        if not metrics_file: return
+        atexit.register(metrics.write)
+        writer_th = threading.Thread(target=metrics.loop)
+        writer_th.daemon = True
+        writer_th.start()
+
+    @staticmethod
+    def loop():
+        while True:
+            time.sleep(metrics.interval)
+            metrics.write()
+
+    @staticmethod
+    def count(name, nb=1):
+        with metrics.lock:
+            metrics.counters[name] += nb
+
+    @staticmethod
+    def observe(name, value):
+        with metrics.lock:
+            counts, total = metrics.histograms[name]
+            counts[bisect.bisect_left(metrics.buckets[name], value)] += 1
+            metrics.histograms[name] = (counts, total + value)
+
+    # a run slot is taken, after waiting for it
+    @staticmethod
+    def acquired(wait):
+        metrics.observe('queue_wait_seconds', wait)
+        with metrics.lock:
+            metrics.running += 1
+
+    # a run slot is released, status is ok, failed, killed or shared
+    # (binary measured by another run)
+    @staticmethod
+    def released(run_id, elapsed, status, size):
+        metrics.observe('exec_seconds', elapsed)
+        metrics.observe('output_bytes', size)
+        with metrics.lock:
+            metrics.running -= 1
+            metrics.busy += elapsed
+            metrics.counters['runs_' + status] += 1
+            bisect.insort(metrics.slowest, (elapsed, run_id))
+            del metrics.slowest[:-metrics.slowest_max]
+
+    # derived values {name: value}
+    @staticmethod
+    def gauges():
+        uptime = time.time() - metrics.start
+        runs = sum([n for (name, n) in metrics.counters.items()
+                    if name.startswith('runs_')])
+        return {
+            'uptime_seconds': uptime, 'slots': runner.jobs,
+            'running': metrics.running,
+            'runs_per_second': runs / max(uptime, 1e-6),
+            'slot_utilization': (metrics.busy / max(uptime, 1e-6) /
+                                 runner.jobs),
+            'error_rate': (metrics.counters['runs_failed'] +
+                           metrics.counters['runs_killed']) / float(
+                max(runs, 1)),
+        }
+
+    @staticmethod
+    def format_prometheus(gauges):
+        lines = ['# TYPE xplfl_runs_total counter']
+        for (name, n) in sorted(metrics.counters.items()):
+            if not name.startswith('runs_'): continue
+            lines += ['xplfl_runs_total{status="%s"} %d' % (name[5:], n)]
+        for (name, n) in sorted(metrics.counters.items()):
+            if name.startswith('runs_'): continue
+            lines += ['# TYPE xplfl_%s_total counter' % name,
+                      'xplfl_%s_total %d' % (name, n)]
+        for (name, value) in sorted(gauges.items()):
+            lines += ['# TYPE xplfl_%s gauge' % name,
+                      'xplfl_%s %s' % (name, value)]
+        for (name, (counts, total)) in sorted(metrics.histograms.items()):
+            lines += ['# TYPE xplfl_%s histogram' % name]
+            cumul = 0
+            for (bound, n) in zip(metrics.buckets[name] + ['+Inf'], counts):
+                cumul += n
+                lines += ['xplfl_%s_bucket{le="%s"} %d' % (name, bound, cumul)]
+            lines += ['xplfl_%s_sum %s' % (name, total),
+                      'xplfl_%s_count %d' % (name, cumul)]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_json(gauges):
+        return json.dumps({
+            'time': time.time(), 'counters': metrics.counters,
+            'gauges': gauges, 'histograms': dict([
+                    (name, {'buckets': metrics.buckets[name],
+                            'counts': counts, 'sum': total})
+                    for (name, (counts, total)) in
+                    metrics.histograms.items()]),
+            'slowest': [(run_id, elapsed) for (elapsed, run_id) in
+                        reversed(metrics.slowest)]}, sort_keys=True) + '\n'
+
+    # rewrite metrics file atomically, prometheus text format for .prom
+    # files (node-exporter textfile collector), json otherwise
+    @staticmethod
+    def write():
+        with metrics.lock:
+            gauges = metrics.gauges()
+            data = (metrics.file.endswith('.prom') and
+                    metrics.format_prometheus or metrics.format_json)(gauges)
+        with open(metrics.file + '.tmp', 'w') as stream:
+            stream.write(data)
+        os.rename(metrics.file + '.tmp', metrics.file)
 
 
 # ############################################################################
 
 class runner():
 
+    # run command output, keeping only last XRES/XHASH lines and a
+    # bounded tail
+    class output():
+
+        # max length of kept lines
+        line_max = 4096
+
+        def __init__(self, run_id, phase=None, fidelity=None):
+            self.run_id, self.start = run_id, time.time()
+            self.phase, self.fidelity = phase, fidelity
+            self.tail = collections.deque(maxlen=runner.tail_lines)
+            self.xres, self.xhash, self.partial, self.size = None, None, '', 0
+            self.killed = None  # None, 'timeout' or 'dominated'
+            self.timeout = runner.timeout
+            self.log = runner.log_dir and open(os.path.join(
+                    runner.log_dir, run_id + (phase and '.' + phase or '') +
+                    '.log'), 'w')
+
+        def feed(self, data):
+            self.size += len(data)
+            if self.log: self.log.write(data)
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()[:runner.output.line_max]
+            for line in lines: self.line(line[:runner.output.line_max])
+
+        def line(self, line):
+            if line.startswith('XRES'): self.xres = line
+            elif line.startswith('XHASH'): self.xhash = line
+            self.tail.append(line)
+
+        def close(self):
+            if self.partial: self.line(self.partial)
+            self.partial = ''
+            if self.log: self.log.close()
+
+    # completion handle of a run, waited for by runner.wait
+    class handle():
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.killed = None  # killed reason of the run, if any
+            self.callbacks = []
+            self.lock = threading.Lock()
+
+        def join(self):
+            # wait by steps to stay interruptible
+            while not self.event.wait(1.0): pass
+
+        # call func once the run is done
+        def notify(self, func):
+            with self.lock:
+                if not self.event.is_set():
+                    self.callbacks.append(func)
+                    return
+            func()
+
+        def set(self):
+            with self.lock:
+                self.event.set()
+                callbacks, self.callbacks = self.callbacks, []
+            for func in callbacks: func()
+
+    # one thread per run, blocked on the run command output
+    class threads_engine():
+
+        def launch(self, env, output, done):
+            def run_wrapper():
+                status = -1
+                try: status = runner.subcall(runner.command_args(env), output)
+                finally: done(status, output)
+            threading.Thread(target=run_wrapper).start()
+
+    # single thread polling the output of all running commands
+    class events_engine():
+
+        def __init__(self):
+            self.poller = select.poll()
+            self.procs = {}  # {fd: (process, output, done)}
+            self.queue = []
+            self.lock = threading.Lock()
+            self.wakeup_r, self.wakeup_w = os.pipe()
+            self.poller.register(self.wakeup_r, select.POLLIN)
+            loop_th = threading.Thread(target=self.loop)
+            loop_th.daemon = True
+            loop_th.start()
+
+        def launch(self, env, output, done):
+            args = runner.command_args(env)
+            if runner.dryrun:
+                done(runner.subcall(args, output), output)
+                return
+            p = runner.popen(args)
+            with self.lock:
+                self.queue.append((p, output, done))
+            os.write(self.wakeup_w, 'x')
+
+        # end of output: done once the process exited (else reaped on
+        # next loop ticks)
+        def reap(self, p, output, done):
+            if p.poll() is None:
+                self.exiting.append((p, output, done))
+                return
+            output.close()
+            done(p.returncode, output)
+
+        def loop(self):
+            self.exiting = []  # [(process, output, done)] not reaped yet
+            next_check = time.time() + 1.0
+            while True:
+                # wake up regularly to reap exiting runs and to check runs
+                # time limits
+                timeout = (self.exiting and 10 or
+                           runner.limited and 1000 or None)
+                for fd, event in self.poller.poll(timeout):
+                    if fd == self.wakeup_r:
+                        os.read(self.wakeup_r, 4096)
+                        with self.lock:
+                            queue, self.queue = self.queue, []
+                        for (p, output, done) in queue:
+                            fd = p.stdout.fileno()
+                            self.procs.update({fd: (p, output, done)})
+                            self.poller.register(
+                                fd, select.POLLIN | select.POLLHUP)
+                        continue
+                    p, output, done = self.procs[fd]
+                    data = os.read(fd, 65536)
+                    if data:
+                        output.feed(data)
+                        continue
+                    self.poller.unregister(fd)
+                    del self.procs[fd]
+                    p.stdout.close()
+                    self.reap(p, output, done)
+                exiting, self.exiting = self.exiting, []
+                for (p, output, done) in exiting: self.reap(p, output, done)
+                # time limits are checked once per second
+                if not runner.limited or time.time() < next_check: continue
+                next_check = time.time() + 1.0
+                for (p, output, done) in self.procs.values():
+                    runner.check_limits(p, output)
+
+    # runs dispatched to remote worker daemons (see worker class)
+    class remote_engine():
+
+        def __init__(self):
+            self.cond = threading.Condition()
+            self.queue = collections.deque()  # [(env, output, done)]
+            self.workers = []
+            for address in runner.workers:
+                try: self.connect(address)
+                except (socket.error, ValueError) as e:
+                    warning('worker %s: %s' % (address, e))
+            assert self.workers, 'no worker available'
+
+        def connect(self, address):
+            sock = socket.create_connection(worker.parse_address(address))
+            stream = sock.makefile('r')
+            hello = json.loads(stream.readline())
+            remote = {'address': address, 'sock': sock,
+                      'slots': hello['slots'], 'running': {}}
+            info('worker %s: %d slots' % (address, remote['slots']))
+            self.workers.append(remote)
+            recv_th = threading.Thread(
+                target=self.receive, args=(remote, stream))
+            recv_th.daemon = True
+            recv_th.start()
+
+        # total number of slots of connected workers
+        def jobs(self):
+            return sum([remote['slots'] for remote in self.workers])
+
+        def launch(self, env, output, done):
+            if runner.dryrun:
+                done(runner.subcall(runner.command_args(env), output), output)
+                return
+            with self.cond:
+                lost = not self.workers
+                if not lost:
+                    self.queue.append((env, output, done))
+                    self.dispatch()
+            # no worker left: run failed
+            if lost: done(-1, output)
+
+        # send queued runs to least loaded workers (lock held)
+        def dispatch(self):
+            while self.queue:
+                free = [remote for remote in self.workers
+                        if len(remote['running']) < remote['slots']]
+                if not free: return
+                remote = min(free, key=lambda remote: (
+                        float(len(remote['running'])) / remote['slots']))
+                env, output, done = self.queue.popleft()
+                remote['running'].update({output.run_id: (env, output, done)})
+                debug('XSEND %s %s' % (output.run_id, remote['address']))
+                try:
+                    remote['sock'].sendall(json.dumps({
+                                'run_id': output.run_id, 'env': dict(env),
+                                'timeout': runner.timeout}) + '\n')
+                except socket.error: self.lost(remote)
+
+        def receive(self, remote, stream):
+            try:
+                for line in iter(stream.readline, ''):
+                    msg = json.loads(line)
+                    with self.cond:
+                        env, output, done = remote['running'].pop(
+                            msg['run_id'])
+                        self.dispatch()
+                    output.feed(''.join([l + '\n' for l in msg['tail']]))
+                    output.close()
+                    output.xres, output.size = msg['xres'], msg['size']
+                    output.xhash = msg['xhash']
+                    output.killed = msg['killed']
+                    done(msg['status'], output)
+            except (socket.error, ValueError, KeyError): pass
+            with self.cond:
+                self.lost(remote)
+
+        # forget a dead worker and dispatch its runs elsewhere (lock held)
+        def lost(self, remote):
+            if remote not in self.workers: return
+            warning('worker %s lost, restarting its %d runs' % (
+                    remote['address'], len(remote['running'])))
+            self.workers.remove(remote)
+            self.queue.extendleft(remote['running'].values())
+            remote['running'] = {}
+            try: remote['sock'].close()
+            except socket.error: pass
+            if not self.workers:
+                error('no worker left')
+                runner.aborted = 'no worker left'
+                while self.queue:
+                    env, output, done = self.queue.popleft()
+                    done(-1, output)
+            self.dispatch()
+
+    engines = {'threads': threads_engine, 'events': events_engine,
+               'remote': remote_engine}
+
     @staticmethod
     def quote_args(args):
         def sh_quote(arg):
@@ -59,57 +847,344 @@ class runner():
         return ' '.join([sh_quote(a) for a in args])
 
     @staticmethod
-    def setup(jobs=1, run_cmd=None, dryrun=False, **kwargs):
+    def setup(jobs=1, run_cmd=None, dryrun=False, engine='threads',
+              tail_lines=20, log_dir=None, timeout=None, racing=None,
+              workers=None, two_phase=False, measure_cpus=None, **kwargs):
         assert jobs
-        runner.dryrun = dryrun or not run_cmd
-        runner.slots = threading.BoundedSemaphore(value=jobs)
+        runner.workers = workers and workers.split(',') or []
+        runner.dryrun = dryrun or not (run_cmd or runner.workers)
         runner.command = run_cmd or ''
-        runner.threads = {}  # {run_id: thread}
+        runner.two_phase = two_phase
+        runner.aborted = None  # reason to stop the exploration, if any
+        runner.runs = {}  # {run_id: handle}
+        runner.last_id = 0
+        # private generator for dryrun results, so that the exploration
+        # random sequence does not depend on runs completion order
+        runner.random = random.Random(0)
+        runner.tail_lines = tail_lines
+        runner.log_dir = log_dir
+        if log_dir and not os.path.isdir(log_dir): os.makedirs(log_dir)
+        runner.timeout, runner.racing = timeout, racing
+        runner.limited = bool(timeout or racing)
+        # best result and its run time per fidelity, for racing mode
+        runner.best = {}  # {fidelity: (res, run time)}
+        # free measure cpu sets, and runs waiting for one
+        assert not (measure_cpus and runner.workers), 'local runs only'
+        assert not (racing and runner.workers), 'local runs only'
+        runner.cpus = measure_cpus and measure_cpus.split(',') or []
+        runner.measured = bool(runner.cpus)
+        runner.cpus_waiting = collections.deque()
+        runner.cpus_lock = threading.Lock()
+        # builds use all other cpus
+        measure = set(sum(map(runner.cpu_list, runner.cpus), []))
+        runner.build_cpus = ','.join([
+                str(c) for c in range(multiprocessing.cpu_count())
+                if c not in measure]) or None
+        # engines threads may start at once: runner state is set before
+        runner.engine = runner.engines[
+            runner.workers and 'remote' or engine]()
+        # remote runs are bounded by the number of slots of workers
+        runner.jobs = runner.workers and runner.engine.jobs() or jobs
+        runner.slots = threading.BoundedSemaphore(value=runner.jobs)
+
+    # [cpu] of a cpu set string (N or N-M)
+    @staticmethod
+    def cpu_list(cpus):
+        first, sep, last = cpus.partition('-')
+        return range(int(first), int(last or first) + 1)
 
+    # call func(cpus) once a measure cpu set is free
     @staticmethod
-    def subcall(args):
-        debug('XRUN %s' % runner.quote_args(args))
+    def acquire_cpus(func):
+        with runner.cpus_lock:
+            if not runner.cpus:
+                runner.cpus_waiting.append(func)
+                return
+            cpus = runner.cpus.pop(0)
+        func(cpus)
+
+    @staticmethod
+    def release_cpus(cpus):
+        with runner.cpus_lock:
+            if not runner.cpus_waiting:
+                runner.cpus.append(cpus)
+                return
+            func = runner.cpus_waiting.popleft()
+        func(cpus)
+
+    # output of a dryrun given its command args: random results (may be
+    # replaced by synthetic objectives, see utils/bench-engine.py)
+    @staticmethod
+    def dryrun_output(args):
+        return 'XHASH %x\nXRES %d\n' % (
+            runner.random.getrandbits(8), runner.random.randint(5, 10))
+
+    @staticmethod
+    def subcall(args, output):
         if runner.dryrun:
-            return 0, 'XRES %d' % (random.randint(5, 10))
+            debug('XRUN %s' % runner.quote_args(args))
+            output.feed(runner.dryrun_output(args))
+            output.close()
+            return 0
+        p = runner.popen(args)
+        fd = p.stdout.fileno()
+        while True:
+            if runner.limited:
+                # wake up regularly to check run time limits
+                runner.check_limits(p, output)
+                if not select.select([fd], [], [], 1.0)[0]: continue
+            data = os.read(fd, 65536)
+            if not data: break
+            output.feed(data)
+        p.stdout.close()
+        output.close()
+        return p.wait()
+
+    # local command given run environment [(name, value)]
+    @staticmethod
+    def command_args(env):
+        return (['/usr/bin/env'] + ['%s=%s' % (n, v) for (n, v) in env] +
+                shlex.split(runner.command))
+
+    @staticmethod
+    def popen(args):
+        debug('XRUN %s' % runner.quote_args(args))
+        # own process group when runs may be killed with all their children
+        start = time.time()
         p = subprocess.Popen(
             args, close_fds=True,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout, stderr = p.communicate()
-        return p.returncode, stdout
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            preexec_fn=runner.limited and os.setsid or None)
+        metrics.observe('spawn_seconds', time.time() - start)
+        return p
+
+    # kill a run exceeding its timeout or, in racing mode, running longer
+    # than a factor of the run time of the best result so far
+    @staticmethod
+    def check_limits(p, output):
+        elapsed = time.time() - output.start
+        if output.killed: return
+        elif output.timeout and elapsed > output.timeout:
+            output.killed = 'timeout'
+        # builds are not raced against measured run times
+        elif (runner.racing and output.phase != 'build' and
+              output.fidelity in runner.best and
+              elapsed > runner.racing * runner.best[output.fidelity][1]):
+            output.killed = 'dominated'
+        else: return
+        debug('XKILL %s %s %.1fs' % (output.run_id, output.killed, elapsed))
+        try: os.killpg(p.pid, signal.SIGKILL)
+        except OSError: pass
 
     @staticmethod
     def finalize():
         runner.wait()
+        gauges = metrics.gauges()
+        info('XMETRICS %.1f runs/s, %.0f%% slots utilization, '
+             '%.0f%% errors' % (gauges['runs_per_second'],
+                                100 * gauges['slot_utilization'],
+                                100 * gauges['error_rate']))
+        if failures.index:
+            info('XFAILURES %d failing flags sets, %d configs pruned' % (
+                    len(failures.index), failures.hits))
 
     @staticmethod
     def new_id(config):
-        # hashlib.sha1(config).hexdigest()
-        return 'RUN-' + str(int(time.time() * 1000000))
+        # timestamp based, kept unique for runs started in the same usec
+        runner.last_id = max(runner.last_id + 1, int(time.time() * 1000000))
+        return 'RUN-' + str(runner.last_id)
 
     @staticmethod
     def wait(run_ids=None):
-        run_ids = run_ids or runner.threads.keys()
-        for run_id in run_ids: runner.threads[run_id].join()
+        run_ids = run_ids or runner.runs.keys()
+        for run_id in run_ids: runner.runs[run_id].join()
 
     @staticmethod
-    def start(config):
-        def run_wrapper(config, run_id):
+    def start(config, fidelity=None):
+        def run_done(status, output):
+            res = -1
             try:
-                status, output = runner.subcall(
-                    ['/usr/bin/env', 'XRUNID=' + run_id, 'XFLAGS=' + config] +
-                    shlex.split(runner.command))
-                results.update(run_id, config, status, output)
+                res = results.update(run_id, config, status, output)
+                journal.record(seq, run_id, config, status, res, start,
+                               fidelity, output.killed)
+                # killed runs did not fail by themselves
+                if res > 0 or not output.killed:
+                    failures.learn(config, res == -1)
+                best_res = runner.best.get(fidelity, (sys.maxint,))[0]
+                if res > 0 and res < best_res:
+                    runner.best[fidelity] = (
+                        res, time.time() - output.start)
             finally:
+                # results of killed runs depend on other runs: not cached
+                for key in keys:
+                    if output.killed: cache.discard(key)
+                    else: cache.insert(key, res)
+                metrics.released(
+                    run_id, time.time() - start, output.killed and 'killed'
+                    or res == -1 and 'failed' or 'ok', output.size)
                 runner.slots.release()
-        runner.slots.acquire()
+                handle.killed = output.killed
+                handle.set()
+        def build_done(status, output):
+            # failed build or no binary hash: end of run
+            if status or not output.xhash:
+                return run_done(status, output)
+            # measure each binary only once
+            bin_key = cache.binary_key(output.xhash.split()[-1], fidelity)
+            res, orig_id = cache.lookup(bin_key, run_id)
+            if res is not None or orig_id:
+                metrics.released(
+                    run_id, time.time() - start, 'shared', output.size)
+                runner.slots.release()
+                debug('XBINHIT %s %s' % (run_id, output.xhash))
+            if res is not None:
+                shared_done(res)
+            elif orig_id:
+                runner.runs[orig_id].notify(lambda: shared_done(
+                        results.results.get(orig_id, -1),
+                        runner.runs[orig_id].killed))
+            else:
+                keys.append(bin_key)
+                measure(env + [('XPHASE', 'run')], 'run')
+        def measure(env, phase):
+            # runs (or run phases) are pinned to a measure cpu set, if any
+            def launch(cpus):
+                def measure_done(status, output):
+                    runner.release_cpus(cpus)
+                    run_done(status, output)
+                runner.engine.launch(env + [('XCPUS', cpus)],
+                                     runner.output(run_id, phase, fidelity),
+                                     measure_done)
+            if runner.measured: runner.acquire_cpus(launch)
+            else: runner.engine.launch(
+                env, runner.output(run_id, phase, fidelity), run_done)
+        # result of another run (killed ones are not cached)
+        def shared_done(res, killed=None):
+            results.add(run_id, config, res)
+            journal.record(
+                seq, run_id, config, None, res, start, fidelity, killed)
+            if killed: cache.discard(keys[0])
+            else: cache.insert(keys[0], res)
+            handle.killed = killed
+            handle.set()
+        seq, start = journal.new_seq(), time.time()
+        keys = [cache.key(config, fidelity)]
+        handle = runner.handle()
+        entry = journal.lookup(seq, config, fidelity)
+        if entry:
+            # already run in a previous session
+            run_id = entry['run_id']
+            debug('XREPLAY %s' % run_id)
+            results.add(run_id, config, entry['res'],
+                        entry.get('objectives'))
+            if not entry.get('killed'): cache.insert(keys[0], entry['res'])
+            handle.killed = entry.get('killed')
+            runner.runs.update({run_id: handle})
+            handle.set()
+            return run_id
         run_id = runner.new_id(config)
-        run_th = threading.Thread(
-            target=run_wrapper, args=(config, run_id))
-        runner.threads.update({run_id: run_th})
-        run_th.start()
+        runner.runs.update({run_id: handle})
+        subset = failures.lookup(config)
+        if subset:
+            # containing known failing flags: not run, failed
+            debug('XPRUNE %s %s' % (run_id, ' | '.join(sorted(subset))))
+            metrics.count('failure_hits')
+            results.add(run_id, config, -1)
+            journal.record(seq, run_id, config, None, -1, start, fidelity)
+            handle.set()
+            return run_id
+        res, orig_id = cache.lookup(keys[0], run_id)
+        if res is not None:
+            # already evaluated: no need for a run slot
+            debug('XHIT %s' % run_id)
+            metrics.count('cache_hits')
+            shared_done(res)
+            return run_id
+        if orig_id:
+            # same config already running: wait for its result
+            debug('XHIT %s %s' % (run_id, orig_id))
+            metrics.count('cache_hits')
+            runner.runs[orig_id].notify(lambda: shared_done(
+                    results.results.get(orig_id, -1),
+                    runner.runs[orig_id].killed))
+            return run_id
+        runner.slots.acquire()
+        metrics.acquired(time.time() - start)
+        start = time.time()
+        env = [('XRUNID', run_id), ('XFLAGS', config)]
+        if fidelity is not None: env += [('XFIDELITY', str(fidelity))]
+        if runner.two_phase:
+            build_env = env + [('XPHASE', 'build')]
+            if runner.measured and runner.build_cpus:
+                build_env += [('XCPUS', runner.build_cpus)]
+            runner.engine.launch(
+                build_env, runner.output(run_id, 'build'), build_done)
+        else: measure(env, None)
         return run_id
 
 
+# ############################################################################
+
+class worker():
+
+    # [HOST:]PORT address, localhost by default
+    @staticmethod
+    def parse_address(address):
+        host, sep, port = address.rpartition(':')
+        return host or 'localhost', int(port)
+
+    # runs requests from drivers with the local engine, using a
+    # json-lines protocol:
+    #   worker: {slots, command}, then {run_id, status, xres, tail, ...}
+    #   driver: {run_id, env, timeout}
+    @staticmethod
+    def serve(address):
+        # runs may be given a timeout by drivers
+        runner.limited = True
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(worker.parse_address(address))
+        server.listen(8)
+        info('worker listening on %s with %d slots' % (address, runner.jobs))
+        while True:
+            conn, peer = server.accept()
+            info('driver connected from %s:%d' % peer)
+            session_th = threading.Thread(
+                target=worker.session, args=(conn,))
+            session_th.daemon = True
+            session_th.start()
+
+    @staticmethod
+    def session(conn):
+        lock = threading.Lock()
+        def send(msg):
+            with lock: conn.sendall(json.dumps(msg) + '\n')
+        def run_done(status, output):
+            runner.slots.release()
+            try:
+                send({'run_id': output.run_id, 'status': status,
+                      'xres': output.xres, 'xhash': output.xhash,
+                      'tail': list(output.tail),
+                      'size': output.size, 'killed': output.killed})
+            except socket.error: pass  # lost driver
+        send({'slots': runner.jobs, 'command': runner.command})
+        stream = conn.makefile('r')
+        try:
+            for line in iter(stream.readline, ''):
+                msg = json.loads(line)
+                # only pass xplfl variables to the run command
+                env = [(n, v) for (n, v) in sorted(msg['env'].items())
+                       if re.match('^X[A-Z]+$', n)]
+                output = runner.output(msg['run_id'])
+                output.timeout = msg.get('timeout') or runner.timeout
+                # slots are shared by the runs of all drivers
+                runner.slots.acquire()
+                runner.engine.launch(env, output, run_done)
+        except (socket.error, ValueError, KeyError): pass
+        info('driver disconnected')
+        conn.close()
+
+
 # ############################################################################
 
 class opt_flag_list():
@@ -149,6 +1224,24 @@ class opt_flag_list():
                 return list(self.choice)
             else: assert 0
 
+        # number of possible values (levels) of the flag
+        def levels(self):
+            if self.range:
+                flag, min, max, step = self.range
+                return (max - min) / step + 1
+            elif self.choice:
+                return len(self.choice)
+            else: assert 0
+
+        # flag string of a given level
+        def level_str(self, level):
+            if self.range:
+                flag, min, max, step = self.range
+                return '%s%d' % (flag, min + level * step)
+            elif self.choice:
+                return self.choice[level]
+            else: assert 0
+
         @staticmethod
         def flag_name(s):
             # bad idea - not unique
@@ -181,18 +1274,67 @@ class opt_flag_list():
             # choice flag
             choices = [w.strip() for w in line.split('|')]
             self.flags.extend([opt_flag_list.opt_flag(fchoice=choices)])
-
-    def find(self, flagstr):
+        # index flags by choice strings and by range prefix
+        # (first declared flag wins, as for a linear search)
+        self.choices, self.ranges = {}, {}
         for flag in self.flags:
             if flag.choice:
-                if flagstr in flag.choice: return flag
+                for choice in flag.choice:
+                    self.choices.setdefault(choice, flag)
             elif flag.range:
-                # TODO: stop using flag_name here. potential issue if several
-                # range flags (with different ranges) share the same name
-                if (opt_flag_list.opt_flag.flag_name(flag.rand()) ==
-                    opt_flag_list.opt_flag.flag_name(flagstr)): return flag
+                self.ranges.setdefault(flag.range[0], flag)
             else: assert 0
-        return None
+
+    # range flag value, split as (prefix, digits)
+    _range_value = re.compile('^(.*?)([0-9]+)$')
+
+    def find(self, flagstr):
+        flag = self.choices.get(flagstr)
+        if flag: return flag
+        reobj = opt_flag_list._range_value.match(flagstr)
+        if not reobj: return None
+        # a prefix ending with '-' (as in "-falign-loops=-[1..8]"), or
+        # else a negative value
+        prefix = reobj.group(1)
+        return self.ranges.get(prefix) or (
+            prefix.endswith('-') and self.ranges.get(prefix[:-1]) or None)
+
+    # encoded configs are vectors with one level per flag (-1 if absent)
+
+    # [(flag, flag_str)] of an encoded config
+    def render(self, vector):
+        if numpy and isinstance(vector, numpy.ndarray):
+            slots = numpy.flatnonzero(vector >= 0).tolist()
+        else: slots = [i for (i, l) in enumerate(vector) if l >= 0]
+        return [(self.flags[i], self.flags[i].level_str(int(vector[i])))
+                for i in slots]
+
+    # batch of nb unique random encoded configs (numpy only), given the
+    # probability of each flag (prob) or the number of flags (seqlen)
+    def random_batch(self, rng, nb, prob=None, seqlen=None):
+        nbflags = len(self.flags)
+        levels = numpy.array([f.levels() for f in self.flags])
+        batch = (rng.random_sample((nb, nbflags)) * levels).astype(int)
+        if prob is not None:
+            absent = rng.random_sample((nb, nbflags)) >= prob
+        else:
+            absent = numpy.ones((nb, nbflags), dtype=bool)
+            present = numpy.argsort(
+                rng.random_sample((nb, nbflags)), axis=1)[:, :seqlen]
+            absent[numpy.arange(nb)[:, None], present] = False
+        batch[absent] = -1
+        # remove duplicates, keeping generation order
+        _, index = numpy.unique(batch, axis=0, return_index=True)
+        return batch[numpy.sort(index)]
+
+    # copy of a batch of encoded configs (numpy only), where each flag is
+    # changed with probability rate to a random level or removed
+    def mutate_batch(self, rng, batch, rate):
+        levels = numpy.array([f.levels() for f in self.flags])
+        changed = rng.random_sample(batch.shape) < rate
+        values = (rng.random_sample(batch.shape) * levels).astype(int)
+        values[rng.random_sample(batch.shape) < 0.5] = -1
+        return numpy.where(changed, values, batch)
 
     @staticmethod
     def parse_line(cmdline):
@@ -209,6 +1351,62 @@ class opt_flag_list():
         return result
 
 
+# ############################################################################
+
+class surrogate():
+
+    # ridge regression model of results given encoded configs, with
+    # pairwise interactions of its most significant features (numpy only)
+
+    def __init__(self, flags_list, ridge=1.0, pairs=8):
+        self.ridge, self.pairs, self.top = ridge, pairs, None
+        levels = numpy.array([f.levels() for f in flags_list.flags])
+        self.ranges = numpy.array([bool(f.range) for f in flags_list.flags])
+        # one column per choice for choice flags,
+        # presence and normalized value columns for range flags
+        width = numpy.where(self.ranges, 2, levels)
+        self.offsets = numpy.cumsum(width) - width
+        self.scale = numpy.maximum(levels - 1, 1).astype(float)
+        self.width = width.sum()
+
+    def features(self, batch):
+        feats = numpy.zeros((len(batch), self.width))
+        rows, slots = numpy.nonzero(batch >= 0)
+        levels, ranges = batch[rows, slots], self.ranges[slots]
+        choices = ~ranges
+        feats[rows[choices],
+              self.offsets[slots[choices]] + levels[choices]] = 1.0
+        feats[rows[ranges], self.offsets[slots[ranges]]] = 1.0
+        feats[rows[ranges], self.offsets[slots[ranges]] + 1] = (
+            levels[ranges] / self.scale[slots[ranges]])
+        if self.top is None: return feats
+        first, second = numpy.triu_indices(len(self.top), 1)
+        return numpy.hstack([feats, (
+                    feats[:, self.top[first]] * feats[:, self.top[second]])])
+
+    def solve(self, feats, values):
+        self.mean = values.mean()
+        values = values - self.mean
+        nb, width = feats.shape
+        # dual form when there are less samples than features
+        if nb < width:
+            return feats.T.dot(numpy.linalg.solve(
+                    feats.dot(feats.T) + self.ridge * numpy.eye(nb), values))
+        return numpy.linalg.solve(
+            feats.T.dot(feats) + self.ridge * numpy.eye(width),
+            feats.T.dot(values))
+
+    def fit(self, batch, values):
+        # first fit a linear model to select interacting features
+        self.top = None
+        weights = self.solve(self.features(batch), values)
+        self.top = numpy.argsort(-numpy.abs(weights))[:self.pairs]
+        self.weights = self.solve(self.features(batch), values)
+
+    def predict(self, batch):
+        return self.features(batch).dot(self.weights) + self.mean
+
+
 # ############################################################################
 
 class cmdline():
@@ -229,6 +1427,44 @@ class cmdline():
         parser.add_option('-j', '--jobs', dest='jobs',
                           action='store', type='int', default=1,
                           help='number of parallel jobs (default: 1)')
+        parser.add_option('-e', '--engine', dest='engine',
+                          action='store', type='choice', default='threads',
+                          choices=sorted(runner.engines.keys()),
+                          help='runs engine: events|threads '
+                          '(default: threads)')
+        parser.add_option('-t', '--timeout', dest='timeout',
+                          action='store', type='float', default=None,
+                          help='kill runs after timeout seconds '
+                          '(default: None)')
+        parser.add_option('--racing', dest='racing',
+                          action='store', type='float', default=None,
+                          help='kill runs slower than factor times the run '
+                          'time of the best result (default: None)')
+        parser.add_option('--two-phase', dest='two_phase',
+                          action='store_true', default=False,
+                          help='separate build and run phases, running '
+                          'identical binaries once (default: False)')
+        parser.add_option('--measure-cpus', dest='measure_cpus',
+                          action='store', type='string', default=None,
+                          help='comma separated list of cpu sets (N or N-M) '
+                          'for measure runs, given as XCPUS (default: None)')
+        parser.add_option('--tail-lines', dest='tail_lines',
+                          action='store', type='int', default=20,
+                          help='output lines kept for failed runs '
+                          '(default: 20)')
+        parser.add_option('--log-dir', dest='log_dir',
+                          action='store', type='string', default=None,
+                          help='directory for full runs output '
+                          '(default: None)')
+        parser.add_option('--metrics-file', dest='metrics_file',
+                          action='store', type='string', default=None,
+                          help='runs metrics filename, in prometheus text '
+                          'format if ending with .prom, json otherwise '
+                          '(default: None)')
+        parser.add_option('--metrics-interval', dest='metrics_interval',
+                          action='store', type='float', default=10,
+                          help='metrics file update period in seconds '
+                          '(default: 10)')
 
         # generators
         group = optparse.OptionGroup(
@@ -242,6 +1478,92 @@ class cmdline():
         group.add_option('-s', '--seed', dest='seed',
                           action='store', type='int', default=None,
                           help='seed for random generator')
+        group.add_option('-o', '--objective', dest='objective',
+                          action='store', type='string', default=None,
+                          help='comma separated list of NAME[:WEIGHT] '
+                          'summed as the result of "XRES NAME=VALUE ..." '
+                          'lines, to be kept positive (default: first '
+                          'value)')
+        group.add_option('--frontier', dest='frontier_file',
+                          action='store', type='string', default=None,
+                          help='pareto frontier of objectives filename '
+                          '(default: None)')
+        group.add_option('--shard', dest='shard',
+                          action='store', type='string', default=None,
+                          help='only enumerate the K-th of N slices of all '
+                          'combinations, given as K/N with 0 <= K < N '
+                          '(default: None)')
+        group.add_option('--start-index', dest='start_index',
+                          action='store', type='long', default=None,
+                          help='index of the first enumerated combination '
+                          '(default: 0 or checkpoint)')
+        group.add_option('--checkpoint', dest='checkpoint_file',
+                          action='store', type='string', default=None,
+                          help='file of the index of the first combination '
+                          'not evaluated yet, to resume from (default: None)')
+        parser.add_option_group(group)
+
+        # distributed runs
+        group = optparse.OptionGroup(
+            parser, 'Distributed', 'dispatch runs to worker daemons')
+        group.add_option('--workers', dest='workers',
+                          action='store', type='string', default=None,
+                          help='comma separated list of [HOST:]PORT workers '
+                          'to run configs (default: None)')
+        group.add_option('--serve', dest='serve',
+                          action='store', type='string', default=None,
+                          help='start a worker daemon on [HOST:]PORT, with '
+                          '-j slots and -r run script (default: None)')
+        parser.add_option_group(group)
+
+        # results journal
+        group = optparse.OptionGroup(
+            parser, 'Journal', 'record runs for resuming an exploration')
+        group.add_option('--journal', dest='journal_file',
+                          action='store', type='string', default=None,
+                          help='journal filename (default: None)')
+        group.add_option('--resume', dest='resume',
+                          action='store_true', default=False,
+                          help='replay runs found in journal (default: False)')
+        parser.add_option_group(group)
+
+        # results cache
+        group = optparse.OptionGroup(
+            parser, 'Cache', 'reuse results of already evaluated flags')
+        group.add_option('--no-cache', dest='no_cache',
+                          action='store_true', default=False,
+                          help='always run duplicated configs '
+                          '(default: False)')
+        group.add_option('--cache-size', dest='cache_size',
+                          action='store', type='int', default=0,
+                          help='max number of cached results '
+                          '(default: 0, no limit)')
+        group.add_option('--cache-policy', dest='cache_policy',
+                          action='store', type='choice', default='lru',
+                          choices=['lru', 'fifo'],
+                          help='cache eviction policy: lru|fifo '
+                          '(default: lru)')
+        group.add_option('--cache-file', dest='cache_file',
+                          action='store', type='string', default=None,
+                          help='persistent cache filename (default: None)')
+        parser.add_option_group(group)
+
+        # failures index
+        group = optparse.OptionGroup(
+            parser, 'Failures', 'skip configs of known failing flags')
+        group.add_option('--no-prune', dest='no_prune',
+                          action='store_true', default=False,
+                          help='run configs of known failing flags '
+                          '(default: False)')
+        group.add_option('--failure-threshold', dest='failure_threshold',
+                          action='store', type='int', default=3,
+                          help='failed runs of a flag or flag pair, never '
+                          'seen in a successful run, for it to be known '
+                          'failing (default: 3)')
+        group.add_option('--failures-file', dest='failures_file',
+                          action='store', type='string', default=None,
+                          help='persistent failing flags filename '
+                          '(default: None)')
         parser.add_option_group(group)
 
         # generators
@@ -304,17 +1626,82 @@ class exploration():
     flags_list = None
     base_flags = None
 
+    # number of configs in generated batches
+    batch_size = 256
+
+    # fidelity of the next configs, given to runs as XFIDELITY (set by
+    # multi-fidelity generators, None for full cost runs)
+    fidelity = None
+
+    # list of configs submitted at once, answered by the list of run_ids
+    # (2-dimensional numpy arrays of encoded configs are batches too)
+    class batch(list): pass
+
     @staticmethod
     def setup(generator=None, flags_list=None, base_flags=None, seed=None,
-              **kwargs):
+              shard=None, start_index=None, checkpoint_file=None, **kwargs):
         assert generator
-        random.seed(seed)
+        # slice K/N of enumerated configs, and first index to enumerate
+        # (by default, last checkpoint of a previous session)
+        exploration.shard = shard and map(int, shard.split('/')) or (0, 1)
+        assert 0 <= exploration.shard[0] < exploration.shard[1], 'bad shard'
+        exploration.checkpoint_file = checkpoint_file
+        if (start_index is None and checkpoint_file and
+            os.path.exists(checkpoint_file)):
+            start_index = long(open(checkpoint_file).read())
+            info('resuming from index %d' % start_index)
+        exploration.start_index = start_index or 0
+        exploration.last_checkpoint = None
+        random.seed(seed if journal.seed is None else journal.seed)
         exploration.flags_list = flags_list and opt_flag_list(flags_list)
         exploration.base_flags = base_flags or ''
         exploration.generator = generator
+        # random state for numpy batches, derived from the main one
+        exploration.rng = numpy and numpy.random.RandomState(
+            random.getrandbits(32))
+        # [(flag, flag_str)] of base flags, for rendering encoded configs
+        exploration.base_items = exploration.flags_list and [
+            (exploration.flags_list.find(x) or x, x) for x in
+            opt_flag_list.parse_line(exploration.flags(''))] or []
+
+    # [first, last) indexes of the current shard among total configs
+    @staticmethod
+    def shard_range(total):
+        shard, nshards = exploration.shard
+        first, last = total * shard / nshards, total * (shard + 1) / nshards
+        return max(first, exploration.start_index), last
+
+    # index of the first config not evaluated yet
+    @staticmethod
+    def checkpoint(index):
+        if index == exploration.last_checkpoint: return
+        exploration.last_checkpoint = index
+        info('XCHECKPOINT %d' % index)
+        if not exploration.checkpoint_file: return
+        with open(exploration.checkpoint_file + '.tmp', 'w') as stream:
+            print >>stream, index
+        os.rename(exploration.checkpoint_file + '.tmp',
+                  exploration.checkpoint_file)
+
+    @staticmethod
+    def is_vector(config):
+        return numpy and isinstance(config, numpy.ndarray) and (
+            config.ndim == 1)
+
+    @staticmethod
+    def is_batch(config):
+        return isinstance(config, exploration.batch) or (
+            numpy and isinstance(config, numpy.ndarray) and config.ndim == 2)
 
     @staticmethod
     def flags(*flags):
+        # encoded config: flags overriding base_flags are moved at the end
+        if len(flags) == 1 and exploration.is_vector(flags[0]):
+            items = exploration.flags_list.render(flags[0])
+            overridden = set([f for (f, x) in items])
+            return ' '.join(
+                [x for (f, x) in exploration.base_items
+                 if f not in overridden] + [x for (f, x) in items])
         # add base_flags and clean resulting list (no dups)
         flags = map(
             lambda f: f if isinstance(f, list) else [f], flags)
@@ -347,7 +1734,8 @@ class exploration():
             lambda k: (results.results[k], k, run_ids[k]), run_ids.keys())
         #    bad flags (slowdown)
         flg = filter(
-            lambda (r, i, f): (r > results.results[ref_id]), run_res)
+            lambda (r, i, f): (r > results.results[ref_id] or r == -2),
+            run_res)
         for (r, i, f) in flg:
             print >>sys.stderr, 'FLAG-BAD  ', i, r, f
         #    error flags
@@ -367,13 +1755,39 @@ class exploration():
         assert exploration.flags_list
         flags_values = map(
             lambda flag: flag.values(), exploration.flags_list.flags)
-        for combination in itertools.product(*flags_values):
-            yield list(combination)
+        # mixed radix numbering of combinations, the last flag varying
+        # the fastest (as in itertools.product)
+        radices = map(len, flags_values)
+        def combination(index):
+            digits = []
+            for radix in reversed(radices):
+                index, digit = divmod(index, radix)
+                digits.append(digit)
+            return [values[d] for (values, d) in
+                    zip(flags_values, reversed(digits))]
+        total = reduce(operator.mul, radices, 1)
+        index, last = exploration.shard_range(total)
+        info('combinations %d to %d of %d' % (index, last, total))
+        pending = collections.deque()  # [(index, run_id)]
+        while index < last:
+            indexes = range(index, min(index + exploration.batch_size, last))
+            run_ids = yield exploration.batch(map(combination, indexes))
+            pending.extend(zip(indexes, run_ids))
+            index = indexes[-1] + 1
+            # all configs before the first still running are evaluated
+            while pending and runner.runs[pending[0][1]].event.is_set():
+                pending.popleft()
+            exploration.checkpoint(pending[0][0] if pending else index)
+        runner.wait([run_id for (i, run_id) in pending])
+        exploration.checkpoint(last)
 
     @generator
     def gen_random_uniform(prob='0.5'):
         """random combinations of compiler flags"""
         assert exploration.flags_list
+        while numpy:
+            yield exploration.flags_list.random_batch(
+                exploration.rng, exploration.batch_size, prob=float(prob))
         while True:
             flags = filter(
                 lambda f: random.random() < float(prob),
@@ -384,6 +1798,9 @@ class exploration():
     def gen_random_fixed(seqlen='5'):
         """random combinations of fixed length"""
         assert exploration.flags_list
+        while numpy:
+            yield exploration.flags_list.random_batch(
+                exploration.rng, exploration.batch_size, seqlen=int(seqlen))
         while True:
             flags = random.sample(exploration.flags_list.flags, int(seqlen))
             yield map(lambda f: f.rand(), flags)
@@ -407,15 +1824,243 @@ class exploration():
             new_flags = new_flags.replace(flag_str, best_flag_str).strip()
         print >>sys.stderr, 'BEST_FLAGS', new_flags
 
+    @generator
+    def gen_tune_parallel(base_flags):
+        """round based pruning/fine-tuning of a given configuration"""
+        assert exploration.flags_list
+        flags_list = exploration.flags_list
+        new_flags = flags_list.parse_line(base_flags)
+        run_id = yield list(new_flags)
+        runner.wait([run_id])
+        best_res = results.results[run_id]
+        assert best_res > 0, 'failed reference run'
+        while True:
+            # evaluate all single flag changes at once
+            changes = []  # [(index, flag_value)]
+            for (idx, flag_str) in enumerate(new_flags):
+                flag = flag_str and flags_list.find(flag_str)
+                if not flag: continue
+                changes.extend([(idx, flag_value) for flag_value in (
+                    [''] + flag.values(nb=10)) if flag_value != flag_str])
+            run_ids = yield exploration.batch([
+                    filter(None, new_flags[:idx] + [flag_value] +
+                           new_flags[idx + 1:])
+                    for (idx, flag_value) in changes])
+            runner.wait(run_ids)
+            # best improving change of each flag {index: (res, len, value)}
+            # (shorter flags with the same result are improvements too)
+            best_changes = {}
+            for ((idx, flag_value), run_id) in zip(changes, run_ids):
+                change = (results.results[run_id], len(flag_value), flag_value)
+                if not (0 < change[0] < best_res or (
+                        0 < change[0] == best_res and
+                        len(flag_value) < len(new_flags[idx]))): continue
+                best_changes[idx] = min(change, best_changes.get(idx, change))
+            if not best_changes: break
+            best_idx = min(best_changes, key=lambda i: best_changes[i])
+            best_res = best_changes[best_idx][0]
+            # all improving changes are combined, when better than the
+            # best single change
+            if len(best_changes) > 1:
+                all_flags = list(new_flags)
+                for (idx, (res, l, flag_value)) in best_changes.items():
+                    all_flags[idx] = flag_value
+                run_id = yield filter(None, all_flags)
+                runner.wait([run_id])
+                if 0 < results.results[run_id] <= best_res:
+                    new_flags, best_res = all_flags, results.results[run_id]
+                    continue
+            new_flags[best_idx] = best_changes[best_idx][2]
+        print >>sys.stderr, 'BEST_FLAGS', ' '.join(filter(None, new_flags))
+
+    @generator
+    def gen_minimize(base_flags, tolerance='0.01'):
+        """delta debugging minimization of a configuration"""
+        assert exploration.flags_list
+        flags = opt_flag_list.parse_line(base_flags)
+        run_id = yield list(flags)
+        runner.wait([run_id])
+        ref_res = results.results[run_id]
+        assert ref_res > 0, 'failed reference run'
+        max_res = ref_res * (1 + float(tolerance))
+        # first try without any flag
+        run_id = yield []
+        runner.wait([run_id])
+        if 0 < results.results[run_id] <= max_res: flags = []
+        nchunks, nruns = 2, 2
+        while len(flags) >= 2:
+            # all chunks and their complements are evaluated at once
+            bounds = [len(flags) * i / nchunks for i in range(nchunks + 1)]
+            chunks = [flags[b:e] for (b, e) in zip(bounds, bounds[1:])]
+            complements = [flags[:b] + flags[e:]
+                           for (b, e) in zip(bounds, bounds[1:])]
+            candidates = chunks + (nchunks > 2 and complements or [])
+            run_ids = yield exploration.batch(candidates)
+            runner.wait(run_ids)
+            nruns += len(run_ids)
+            passed = [(len(c), results.results[k], i) for (i, (c, k)) in
+                      enumerate(zip(candidates, run_ids))
+                      if 0 < results.results[k] <= max_res]
+            if passed:
+                # smallest passing subset (then best result)
+                i = min(passed)[2]
+                flags = candidates[i]
+                nchunks = i < nchunks and 2 or max(nchunks - 1, 2)
+            elif nchunks < len(flags):
+                nchunks = min(2 * nchunks, len(flags))
+            else: break
+            info('minimize: %d flags, %d chunks, %d runs' % (
+                    len(flags), nchunks, nruns))
+        print >>sys.stderr, 'BEST_FLAGS', ' '.join(flags)
+
+    @generator
+    def gen_genetic(popsize='20', generations='10'):
+        """genetic search, evaluating populations in parallel"""
+        assert exploration.flags_list
+        flags, popsize = exploration.flags_list.flags, int(popsize)
+        # individuals are [flag_str or None] lists, one entry per flag
+        def mutate(flag, gene):
+            if random.random() >= 1.0 / len(flags): return gene
+            return random.choice([None, flag.rand()])
+        def crossover(genes1, genes2):
+            return [random.choice(genes) for genes in zip(genes1, genes2)]
+        def tournament(scored):
+            return min(random.sample(scored, 2),
+                       key=operator.itemgetter(0))[1]
+        population = [
+            [random.random() < 0.5 and f.rand() or None for f in flags]
+            for n in range(popsize)]
+        scored = []  # [(result, individual)], lower is better
+        for gen in range(int(generations)):
+            run_ids = yield exploration.batch(
+                [filter(None, genes) for genes in population])
+            runner.wait(run_ids)
+            # keep the best individual of previous generation (elitism)
+            scored = scored[:1] + [
+                (results.results[k] > 0 and results.results[k] or sys.maxint,
+                 genes) for (k, genes) in zip(run_ids, population)]
+            scored.sort(key=operator.itemgetter(0))
+            info('generation %d: best %d' % (gen, scored[0][0]))
+            population = [
+                map(mutate, flags, crossover(
+                        tournament(scored), tournament(scored)))
+                for n in range(popsize - 1)]
+        print >>sys.stderr, 'BEST_FLAGS', exploration.flags(
+            filter(None, scored[0][1]))
+
+    @generator
+    def gen_surrogate(rounds='10', topk='8', candidates='2000'):
+        """surrogate model guided search (needs numpy)"""
+        assert exploration.flags_list and numpy
+        flags_list, rng = exploration.flags_list, exploration.rng
+        topk, candidates = int(topk), int(candidates)
+        model = surrogate(flags_list)
+        explored, values, seen = None, numpy.array([]), set()
+        # first round: random configs
+        batch = flags_list.random_batch(rng, 4 * topk, prob=0.5)
+        for rnd in range(int(rounds) + 1):
+            seen.update([c.tostring() for c in batch])
+            run_ids = yield batch
+            runner.wait(run_ids)
+            explored = batch if explored is None else numpy.vstack(
+                [explored, batch])
+            values = numpy.concatenate([values, numpy.array(
+                        [results.results[k] for k in run_ids], dtype=float)])
+            valid = values > 0
+            if not valid.any():
+                batch = flags_list.random_batch(rng, topk, prob=0.5)
+                continue
+            # fit on log results, failures counting as twice the worst
+            model.fit(explored, numpy.log(
+                    numpy.where(valid, values, 2 * values[valid].max())))
+            order = numpy.argsort(numpy.where(valid, values, numpy.inf))
+            info('round %d: best %d' % (rnd, values[order[0]]))
+            # rank random configs and mutations of the best ones
+            parents = explored[order[:topk]]
+            cands = numpy.vstack([
+                flags_list.random_batch(rng, candidates / 2, prob=0.5),
+                flags_list.mutate_batch(
+                    rng, parents[rng.randint(
+                            len(parents), size=candidates / 2)],
+                    2.0 / len(flags_list.flags))])
+            cands = cands[numpy.array(
+                    [c.tostring() not in seen for c in cands], dtype=bool)]
+            batch = cands[numpy.argsort(model.predict(cands))[:topk]]
+        best = numpy.argmin(numpy.where(values > 0, values, numpy.inf))
+        print >>sys.stderr, 'BEST_FLAGS', exploration.flags(explored[best])
+
+    @generator
+    def gen_hyperband(max_fidelity, min_fidelity='1', eta='3'):
+        """successive halving of random configs on increasing fidelity"""
+        assert exploration.flags_list
+        flags, eta = exploration.flags_list.flags, int(eta)
+        max_fidelity, min_fidelity = int(max_fidelity), int(min_fidelity)
+        assert 0 < min_fidelity <= max_fidelity and eta > 1
+        # number of halvings from min to max fidelity
+        smax = 0
+        while min_fidelity * eta ** (smax + 1) <= max_fidelity: smax += 1
+        best = (sys.maxint, [])  # (result, flags) at max fidelity
+        # brackets from many configs at min fidelity to few at max one,
+        # each one costing about (smax + 1) runs at max fidelity
+        for s in range(smax, -1, -1):
+            nconfigs = ((smax + 1) * eta ** s + s) / (s + 1)
+            configs = [[f.rand() for f in flags if random.random() < 0.5]
+                       for n in range(nconfigs)]
+            for i in range(s + 1):
+                # fidelity (max one at last rung)
+                exploration.fidelity = max(
+                    max_fidelity / eta ** (s - i), min_fidelity)
+                run_ids = yield exploration.batch(configs)
+                runner.wait(run_ids)
+                # failures are ranked last
+                scored = sorted([
+                        (results.results[k] > 0 and results.results[k] or
+                         sys.maxint, n) for (n, k) in enumerate(run_ids)])
+                info('bracket %d, fidelity %d: %d configs, best %s' % (
+                        s, exploration.fidelity, len(configs),
+                        scored[0][0]))
+                if i == s: break
+                # promote the top 1/eta configs to the next fidelity
+                configs = [configs[n] for (r, n) in
+                           scored[:max(len(configs) / eta, 1)]]
+            best = min(best, (scored[0][0], configs[scored[0][1]]))
+        exploration.fidelity = None
+        print >>sys.stderr, 'BEST_FLAGS', exploration.flags(best[1])
+
+    # run learned failing flags sets alone (with base flags), so that
+    # they are only known failing once this run fails too
+    @staticmethod
+    def confirm_failures():
+        for subset in failures.confirmations():
+            exploration.confirm_failure(subset)
+
+    @staticmethod
+    def confirm_failure(subset):
+        run_id = runner.start(
+            exploration.flags(sorted(subset)), exploration.fidelity)
+        handle = runner.runs[run_id]
+        handle.notify(lambda: failures.confirmed(
+                subset, results.results.get(run_id, -1), handle.killed))
+
     @staticmethod
     def loop():
         result = None
-        while True:
+        while not runner.aborted:
+            exploration.confirm_failures()
+            start = time.time()
             try:
                 config = exploration.generator.send(result)
             except StopIteration:
                 break
-            result = runner.start(exploration.flags(config))
+            if exploration.is_batch(config):
+                configs = [exploration.flags(c) for c in config]
+            else: configs = exploration.flags(config)
+            metrics.observe('generate_seconds', time.time() - start)
+            if exploration.is_batch(config):
+                result = [runner.start(c, exploration.fidelity)
+                          for c in configs]
+            else: result = runner.start(configs, exploration.fidelity)
+        exploration.confirm_failures()
 
 
 # ############################################################################
@@ -423,10 +2068,18 @@ class exploration():
 if __name__ == '__main__':
     (opts, args) = cmdline.argparser().parse_args()
     logger.setup(**vars(opts))
+    metrics.setup(**vars(opts))
+    results.setup(**vars(opts))
     runner.setup(**vars(opts))
+    if opts.serve:
+        worker.serve(opts.serve)
+    cache.setup(**vars(opts))
+    failures.setup(**vars(opts))
+    journal.setup(**vars(opts))
     exploration.setup(**vars(opts))
     exploration.loop()
     runner.finalize()
+    if runner.aborted: sys.exit(1)
 
 
 # ############################################################################